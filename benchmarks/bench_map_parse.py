@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Compares the GET_MAP_OBJECTS parsing paths.
+
+Runs the generic path (protobuf_to_dict + parse_map_dict) and the direct
+path (parse_map_objects) over the GET_MAP_OBJECTS responses of raw capture
+files written with --capture-raw, or over synthetic responses if no capture
+is given.
+
+    python benchmarks/bench_map_parse.py [capture.bin ...]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+args = argparse.ArgumentParser(description=__doc__)
+args.add_argument('captures', nargs='*')
+args.add_argument('-n', '--repeat', type=int, default=20)
+args = args.parse_args()
+sys.argv = sys.argv[:1]  # pogom.models parses the command line on import
+
+from pogom.models import parse_map_dict, parse_map_objects
+from pogom.pgoapi.protobuf_to_dict import protobuf_to_dict
+from pogom.pgoapi.raw_capture import read_capture
+from POGOProtos.Networking.Envelopes.ResponseEnvelope_pb2 import ResponseEnvelope
+from POGOProtos.Networking.Requests.RequestType_pb2 import RequestType
+from POGOProtos.Networking.Responses.GetMapObjectsResponse_pb2 import GetMapObjectsResponse
+
+GET_MAP_OBJECTS = RequestType.Value('GET_MAP_OBJECTS')
+
+
+def captured_responses(paths):
+    responses = []
+    for path in paths:
+        for _, request_types, content in read_capture(path):
+            if GET_MAP_OBJECTS not in request_types:
+                continue
+            envelope = ResponseEnvelope()
+            envelope.ParseFromString(content)
+            index = request_types.index(GET_MAP_OBJECTS)
+            if index < len(envelope.returns):
+                responses.append(envelope.returns[index])
+    return responses
+
+
+def synthetic_responses(count=200, seed=0):
+    rnd = random.Random(seed)
+    now = int(time.time() * 1000)
+    responses = []
+    for _ in range(count):
+        response = GetMapObjectsResponse()
+        response.status = 1
+        for _ in range(rnd.randint(2, 9)):
+            cell = response.map_cells.add()
+            cell.s2_cell_id = rnd.getrandbits(63)
+            cell.current_timestamp_ms = now
+            for _ in range(rnd.randint(0, 3)):
+                p = cell.wild_pokemons.add()
+                p.encounter_id = rnd.getrandbits(64)
+                p.spawn_point_id = '%x' % rnd.getrandbits(40)
+                p.latitude = rnd.uniform(-60, 60)
+                p.longitude = rnd.uniform(-180, 180)
+                p.last_modified_timestamp_ms = now
+                p.time_till_hidden_ms = 0 if rnd.random() < 0.1 else rnd.randint(1, 900000)
+                p.pokemon_data.pokemon_id = rnd.randint(1, 151)
+            for _ in range(rnd.randint(0, 6)):
+                f = cell.forts.add()
+                f.id = '%x.16' % rnd.getrandbits(128)
+                f.latitude = rnd.uniform(-60, 60)
+                f.longitude = rnd.uniform(-180, 180)
+                f.enabled = True
+                f.last_modified_timestamp_ms = now
+                f.type = rnd.randint(0, 1)
+                if f.type == 0:
+                    f.owned_by_team = rnd.randint(1, 3)
+                    f.guard_pokemon_id = rnd.randint(1, 151)
+                    f.gym_points = rnd.randint(1, 50000)
+            for _ in range(rnd.randint(0, 4)):
+                s = cell.spawn_points.add()
+                s.latitude = rnd.uniform(-60, 60)
+                s.longitude = rnd.uniform(-180, 180)
+        responses.append(response.SerializeToString())
+    return responses
+
+
+def generic_path(raw):
+    response = GetMapObjectsResponse()
+    response.ParseFromString(raw)
+    return parse_map_dict(protobuf_to_dict(response))
+
+
+def direct_path(raw):
+    response = GetMapObjectsResponse()
+    response.ParseFromString(raw)
+    return parse_map_objects(response)
+
+
+def bench(name, func, responses, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.time()
+        for raw in responses:
+            func(raw)
+        best = min(best, time.time() - start)
+    print('{:8s} {:8.1f} us/response'.format(name, best / len(responses) * 1e6))
+    return best
+
+
+if __name__ == '__main__':
+    responses = captured_responses(args.captures) if args.captures else synthetic_responses()
+    if not responses:
+        sys.exit('No GET_MAP_OBJECTS responses found.')
+    print('{} responses ({})'.format(len(responses), 'captured' if args.captures else 'synthetic'))
+
+    for raw in responses:
+        assert generic_path(raw) == direct_path(raw), 'Parsing paths disagree'
+
+    generic = bench('generic', generic_path, responses, args.repeat)
+    direct = bench('direct', direct_path, responses, args.repeat)
+    print('speedup  {:8.2f}x'.format(generic / direct))
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Microbenchmarks for protobuf_to_dict.
+
+Compares the compiled per-descriptor converters with the previous recursive
+implementation on the response types the scanner receives (the response
+envelope, GET_MAP_OBJECTS and GET_PLAYER), and checks that both produce
+identical dicts for randomly filled instances of every response type.
+Raw capture files written with --capture-raw can be given to benchmark
+recorded responses instead of synthetic ones.
+
+    python benchmarks/bench_protobuf_to_dict.py [capture.bin ...]
+"""
+
+import argparse
+import os
+import pkgutil
+import random
+import sys
+import time
+from importlib import import_module
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pogom.pgoapi import protos
+from pogom.pgoapi.protobuf_to_dict import protobuf_to_dict, TYPE_CALLABLE_MAP, EXTENSION_CONTAINER, repeated, \
+    _get_field_value_adaptor
+from pogom.pgoapi.raw_capture import read_capture
+from pogom.pgoapi.utilities import to_camel_case
+from google.protobuf.descriptor import FieldDescriptor
+from POGOProtos.Networking import Responses
+from POGOProtos.Networking.Envelopes.ResponseEnvelope_pb2 import ResponseEnvelope
+from POGOProtos.Networking.Requests.RequestType_pb2 import RequestType
+
+
+def reference_protobuf_to_dict(pb, type_callable_map=TYPE_CALLABLE_MAP, use_enum_labels=False):
+    # protobuf_to_dict before the converters were compiled per descriptor
+    result_dict = {}
+    extensions = {}
+    for field, value in pb.ListFields():
+        if field.message_type and field.message_type.has_options and field.message_type.GetOptions().map_entry:
+            result_dict[field.name] = dict(value)
+            continue
+        if field.type == FieldDescriptor.TYPE_MESSAGE:
+            type_callable = lambda pb: reference_protobuf_to_dict(
+                pb, type_callable_map=type_callable_map, use_enum_labels=use_enum_labels)
+        else:
+            type_callable = _get_field_value_adaptor(pb, field, type_callable_map, use_enum_labels)
+        if field.label == FieldDescriptor.LABEL_REPEATED:
+            type_callable = repeated(type_callable)
+
+        if field.is_extension:
+            extensions[str(field.number)] = type_callable(value)
+            continue
+
+        result_dict[field.name] = type_callable(value)
+
+    if extensions:
+        result_dict[EXTENSION_CONTAINER] = extensions
+    return result_dict
+
+
+def fill(pb, rnd, depth=0):
+    for field in pb.DESCRIPTOR.fields:
+        count = rnd.randint(0, 3) if field.label == FieldDescriptor.LABEL_REPEATED else 1
+        for _ in range(count):
+            if field.type == FieldDescriptor.TYPE_MESSAGE:
+                if depth > 3:
+                    break
+                if field.label == FieldDescriptor.LABEL_REPEATED:
+                    fill(getattr(pb, field.name).add(), rnd, depth + 1)
+                else:
+                    fill(getattr(pb, field.name), rnd, depth + 1)
+                continue
+
+            value = random_value(field, rnd)
+            if field.label == FieldDescriptor.LABEL_REPEATED:
+                getattr(pb, field.name).append(value)
+            else:
+                setattr(pb, field.name, value)
+    return pb
+
+
+def random_value(field, rnd):
+    t = field.type
+    if t in (FieldDescriptor.TYPE_DOUBLE, FieldDescriptor.TYPE_FLOAT):
+        return float(rnd.randint(-1000, 1000)) / 8
+    if t == FieldDescriptor.TYPE_BOOL:
+        return rnd.random() < 0.5
+    if t == FieldDescriptor.TYPE_STRING:
+        return u'%x' % rnd.getrandbits(48)
+    if t == FieldDescriptor.TYPE_BYTES:
+        return os.urandom(rnd.randint(0, 16))
+    if t == FieldDescriptor.TYPE_ENUM:
+        return rnd.choice(field.enum_type.values).number
+    if t in (FieldDescriptor.TYPE_UINT32, FieldDescriptor.TYPE_FIXED32):
+        return rnd.getrandbits(31)
+    if t in (FieldDescriptor.TYPE_UINT64, FieldDescriptor.TYPE_FIXED64):
+        return rnd.getrandbits(63)
+    return rnd.randint(-2 ** 30, 2 ** 30)
+
+
+def response_classes():
+    for _, name, _ in pkgutil.iter_modules(Responses.__path__):
+        module = import_module('POGOProtos.Networking.Responses.' + name)
+        yield getattr(module, name[:-len('_pb2')])
+
+
+def response_class(request_type):
+    name = to_camel_case(RequestType.Name(request_type).lower()) + 'Response'
+    return getattr(import_module('POGOProtos.Networking.Responses.' + name + '_pb2'), name)
+
+
+def captured_messages(paths):
+    messages = {}
+    for path in paths:
+        for _, request_types, content in read_capture(path):
+            envelope = ResponseEnvelope()
+            envelope.ParseFromString(content)
+            for request_type, raw in zip(request_types, envelope.returns):
+                cls = response_class(request_type)
+                messages.setdefault(cls.__name__, []).append(cls.FromString(raw))
+            envelope.ClearField('returns')
+            messages.setdefault('ResponseEnvelope', []).append(envelope)
+    return messages
+
+
+def synthetic_messages(rnd):
+    messages = {}
+    for cls in (ResponseEnvelope, response_class(RequestType.Value('GET_MAP_OBJECTS')),
+                response_class(RequestType.Value('GET_PLAYER'))):
+        messages[cls.__name__] = [fill(cls(), rnd) for _ in range(50)]
+    return messages
+
+
+def bench(func, messages, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.time()
+        for pb in messages:
+            func(pb)
+        best = min(best, time.time() - start)
+    return best / len(messages) * 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('captures', nargs='*')
+    parser.add_argument('-n', '--repeat', type=int, default=20)
+    args = parser.parse_args()
+    rnd = random.Random(0)
+
+    for cls in response_classes():
+        for _ in range(5):
+            pb = fill(cls(), rnd)
+            assert protobuf_to_dict(pb) == reference_protobuf_to_dict(pb), cls.__name__
+            assert protobuf_to_dict(pb, use_enum_labels=True) == \
+                reference_protobuf_to_dict(pb, use_enum_labels=True), cls.__name__
+    print('Output identical for all response types.')
+
+    messages = captured_messages(args.captures) if args.captures else synthetic_messages(rnd)
+    print('{:28s} {:>12s} {:>12s} {:>8s}'.format('message', 'reference', 'compiled', 'speedup'))
+    for name, pbs in sorted(messages.items()):
+        for pb in pbs:
+            assert protobuf_to_dict(pb) == reference_protobuf_to_dict(pb), name
+        reference = bench(reference_protobuf_to_dict, pbs, args.repeat)
+        compiled = bench(protobuf_to_dict, pbs, args.repeat)
+        print('{:28s} {:9.1f} us {:9.1f} us {:7.2f}x'.format(name, reference, compiled, reference / compiled))
@@ -12,5 +12,11 @@ config = {
     ],
     'ROOT_PATH': None,
     'CONFIG_PATH': None,
-    'SIGNATURE_LIB_PATH': None
+    'CACHE_PATH': None,
+    'SCAN_MODE': 'hex',
+    'COVER_MODE': 'hex',
+    'LOGIN_THREADS': 4,
+    'LOGIN_QUORUM': 0.5,
+    'SIGNATURE_LIB_PATH': None,
+    'TOKEN_CACHE_KEY': None
 }
@@ -3,28 +3,42 @@
 
 import logging
 import calendar
-from flask import Flask, jsonify, render_template, request, abort, redirect, url_for, make_response
+from flask import Flask, Response, jsonify, render_template, request, abort, redirect, url_for, make_response
 from flask.json import JSONEncoder
 from datetime import datetime
 import time
+import math
 import json
 import threading
 import random
 import string
 import os
+import zlib
+import hashlib
 
 from . import config
-from .models import Pokemon, Gym, Pokestop
+from .models import PokemonStats, HeatmapCell
 from .scan import ScanMetrics, Scanner
-from .utils import get_locale
+from .events import Broadcaster
+from .utils import get_locale, get_pokemon_name
 
 log = logging.getLogger(__name__)
 
+BOUNDS_GRID = 0.01  # degrees, cell size of the live state's spatial grid
+
 
 class Pogom(Flask):
-    def __init__(self, scan_config, *args, **kwargs):
+    def __init__(self, scan_config, live_state, *args, **kwargs):
         super(Pogom, self).__init__(*args, **kwargs)
         self.scan_config = scan_config
+        self.live_state = live_state
+
+        self.map_data_cache = ResponseCache()
+        self.broadcaster = Broadcaster()
+        self.live_state.add_listener(self.publish_changes)
+        status_thread = threading.Thread(target=self.publish_status, name='status_thread')
+        status_thread.daemon = True
+        status_thread.start()
 
         self.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
         self.json_encoder = CustomJSONEncoder
@@ -32,10 +46,13 @@ class Pogom(Flask):
         self.route('/', methods=['GET'])(self.fullmap)
         self.route('/heatmap-data', methods=['GET'])(self.heatmap_data)
         self.route('/map-data', methods=['GET'])(self.map_data)
+        self.route('/status', methods=['GET'])(self.status)
+        self.route('/stream', methods=['GET'])(self.stream)
         self.route('/cover', methods=['GET'])(self.cover)
         self.route('/location', methods=['POST'])(self.add_location)
         self.route('/location', methods=['DELETE'])(self.delete_location)
         self.route('/stats', methods=['GET'])(self.stats)
+        self.route('/account-stats', methods=['GET'])(self.account_stats)
         self.route('/config', methods=['GET'])(self.get_config_site)
         self.route('/config', methods=['POST'])(self.post_config_site)
         self.route('/login', methods=['GET', 'POST'])(self.login)
@@ -70,7 +87,11 @@ class Pogom(Flask):
             return resp
 
     def heatmap_data(self):
-        return jsonify( Pokemon.get_heat_stats() )
+        pokemon_ids = [int(i) for i in request.args.get('pokemon', '').split(',') if i.isdigit()]
+        if not pokemon_ids:
+            return jsonify([])
+        return jsonify(HeatmapCell.get_heatmap(pokemon_ids, bounds=self.get_bounds(),
+                                               zoom=request.args.get('zoom', type=int)))
 
     def get_config_site(self):
         if not self.is_authenticated():
@@ -113,10 +134,9 @@ class Pogom(Flask):
                     usernames.add(a[0].strip())
 
         config['ACCOUNTS'] = accounts_parsed
-        self.scan_config.ACCOUNTS_CHANGED = (usernames_before != usernames)
         self.save_config()
 
-        self.scan_config.RESTART = True
+        self.scan_config.restart(accounts_changed=(usernames_before != usernames))
 
         resp = make_response(render_template(
             'config.html',
@@ -147,41 +167,114 @@ class Pogom(Flask):
                     'CONFIG_PASSWORD': config['CONFIG_PASSWORD'],
                     'SCAN_LOCATIONS': self.scan_config.SCAN_LOCATIONS.values(),
                     'ACCOUNTS': config['ACCOUNTS']}
+            if config.get('TOKEN_CACHE_KEY', None):
+                data['TOKEN_CACHE_KEY'] = config['TOKEN_CACHE_KEY']
             f.write(json.dumps(data))
 
-    def map_data(self):
-        d = {}
-
+    @staticmethod
+    def get_bounds():
+        bounds = tuple(request.args.get(k, type=float) for k in ('swLat', 'swLng', 'neLat', 'neLng'))
+        if None in bounds:
+            return None
+        return bounds
+
+    @staticmethod
+    def snap_bounds(bounds):
+        """Widens the bounds to the BOUNDS_GRID, so clients looking at about the
+        same area share a cached response."""
+        if bounds is None:
+            return None
+        sw_lat, sw_lng, ne_lat, ne_lng = bounds
+        return (math.floor(sw_lat / BOUNDS_GRID) * BOUNDS_GRID, math.floor(sw_lng / BOUNDS_GRID) * BOUNDS_GRID,
+                math.ceil(ne_lat / BOUNDS_GRID) * BOUNDS_GRID, math.ceil(ne_lng / BOUNDS_GRID) * BOUNDS_GRID)
+
+    @staticmethod
+    def get_time_since_last_request():
         if not ScanMetrics.LAST_SUCCESSFUL_REQUEST:
-            time_since_last_req = "na"
+            return "na"
         elif ScanMetrics.LAST_SUCCESSFUL_REQUEST == -1:
-            time_since_last_req = "sleep"
+            return "sleep"
         else:
-            time_since_last_req = time.time() - ScanMetrics.LAST_SUCCESSFUL_REQUEST
+            return time.time() - ScanMetrics.LAST_SUCCESSFUL_REQUEST
 
-        d['server_status'] = {'num-threads': ScanMetrics.NUM_THREADS,
-                              'num-accounts': ScanMetrics.NUM_ACCOUNTS,
-                              'last-successful-request': time_since_last_req,
-                              'complete-scan-time': ScanMetrics.COMPLETE_SCAN_TIME,
-                              'current-scan-percent': ScanMetrics.CURRENT_SCAN_PERCENT}
+    def get_server_status(self):
+        return {'num-threads': ScanMetrics.NUM_THREADS,
+                'num-accounts': ScanMetrics.NUM_ACCOUNTS,
+                'last-successful-request': self.get_time_since_last_request(),
+                'complete-scan-time': ScanMetrics.COMPLETE_SCAN_TIME,
+                'current-scan-percent': ScanMetrics.CURRENT_SCAN_PERCENT,
+                'work-queue': ScanMetrics.WORK_QUEUE,
+                'pacing': dict((k, v) for k, v in ScanMetrics.PACING.iteritems() if k != 'accounts'),
+                'logins': ScanMetrics.LOGINS}
 
-        d['scan_locations'] = self.scan_config.SCAN_LOCATIONS
+    def status(self):
+        return jsonify(self.get_server_status())
 
-        if request.args.get('pokemon', 'true') == 'true':
-            d['pokemons'] = Pokemon.get_active()
+    def map_data(self):
+        query = (request.args.get('pokemon', 'true') == 'true',
+                 request.args.get('pokestops', 'false') == 'true',
+                 request.args.get('gyms', 'true') == 'true',
+                 self.snap_bounds(self.get_bounds()),
+                 request.args.get('since', type=int))
 
-        if request.args.get('pokestops', 'false') == 'true':
-            d['pokestops'] = Pokestop.get_all()
+        # Everything the response depends on. The scan locations and the
+        # locale only change when they are configured. The server status is
+        # served by /status and the event stream.
+        self.live_state.expire()
+        version = (self.live_state.seq, self.scan_config.COVER_KEY, config['LOCALE'])
 
-        # TODO: Lured pokestops
+        return self.map_data_cache.response(version, query, self._build_map_data)
 
-        if request.args.get('gyms', 'true') == 'true':
-            d['gyms'] = Gym.get_all()
+    def _build_map_data(self, query):
+        pokemons, pokestops, gyms, bounds, since = query
+
+        d = {}
+        d['scan_locations'] = self.scan_config.SCAN_LOCATIONS
 
-        return jsonify(d)
+        # TODO: Lured pokestops
+        d.update(self.live_state.get_map_data(
+            bounds=bounds, since=since,
+            pokemons=pokemons, pokestops=pokestops, gyms=gyms))
+
+        return d
+
+    def publish_changes(self, seq, changes):
+        if not self.broadcaster.num_clients():
+            return
+
+        changes = dict(changes, seq=seq)
+        if changes.get('pokemons'):
+            changes['pokemons'] = [dict(p, pokemon_name=get_pokemon_name(p['pokemon_id']))
+                                   for p in changes['pokemons']]
+        self.broadcaster.publish('map', json.dumps(changes, cls=CustomJSONEncoder))
+
+    def publish_status(self):
+        while True:
+            time.sleep(2)
+            if self.broadcaster.num_clients():
+                self.broadcaster.publish('status', json.dumps(self.get_server_status()))
+
+    def stream(self):
+        client = self.broadcaster.subscribe()
+
+        def generate():
+            try:
+                yield 'retry: 5000\n\n'
+                while not client.dropped:
+                    message = client.get(timeout=15)
+                    if message is None:
+                        yield ':\n\n'  # keep-alive
+                    elif not client.dropped:
+                        yield message
+            finally:
+                self.broadcaster.unsubscribe(client)
+
+        return Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
     def cover(self):
         return jsonify({'cover': self.scan_config.COVER,
+                        'cover_stats': self.scan_config.COVER_STATS,
                         'scan_locations': self.scan_config.SCAN_LOCATIONS.values()})
 
     def add_location(self):
@@ -216,14 +309,69 @@ class Pogom(Flask):
         return ('', 204)
 
     def stats(self):
-        stats = Pokemon.get_stats()
+        stats = PokemonStats.get_stats()
         count = sum(p['count'] for p in stats)
         return render_template('stats.html', pokemons=stats, total=count)
 
+    def account_stats(self):
+        # Lists the accounts, so it's only for those allowed to configure them
+        if not self.is_authenticated():
+            return redirect(url_for('login'))
+
+        return jsonify(ScanMetrics.PACING.get('accounts', {}))
+
     def locale(self):
         return jsonify(get_locale())
 
 
+class ResponseCache(object):
+    """Serialized JSON responses shared by all clients.
+
+    Bodies are cached per data version and query. Each one is serialized and
+    gzipped once and served with an ETag, so repeated polls of unchanged
+    data get a 304. Entries of older versions are dropped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._entries = {}
+
+    def _get(self, version, query, build):
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._entries = {}
+            entry = self._entries.get(query)
+        if entry is not None:
+            return entry
+
+        body = json.dumps(build(query), cls=CustomJSONEncoder, separators=(',', ':'))
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        entry = (hashlib.md5(body).hexdigest(), body,
+                 compressor.compress(body) + compressor.flush())
+
+        with self._lock:
+            if version == self._version:
+                self._entries[query] = entry
+        return entry
+
+    def response(self, version, query, build):
+        etag, body, gzipped = self._get(version, query, build)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        elif 'gzip' in request.headers.get('Accept-Encoding', ''):
+            response = Response(gzipped, mimetype='application/json')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(body, mimetype='application/json')
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+
 class CustomJSONEncoder(JSONEncoder):
     def default(self, obj):
         try:
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+import math
+import time
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+
+SCAN_RADIUS = 70
+HEX_DISTANCE = math.sqrt(3) * SCAN_RADIUS
+
+
+def _radii(lat):
+    # Meridional and prime vertical radii of curvature (lat in radians)
+    w2 = 1 - WGS84_E2 * np.sin(lat) ** 2
+    return WGS84_A * (1 - WGS84_E2) / (w2 * np.sqrt(w2)), WGS84_A / np.sqrt(w2)
+
+
+def direct(lat, lng, azimuth, distance):
+    """Batched geodesic step on the ellipsoid (all angles in radians).
+
+    Integrates the geodesic equations with a single midpoint step, which for
+    hops of a few hundred metres stays well below a millimetre of the exact
+    WGS84 solution.
+    """
+    m, n = _radii(lat)
+    dlat = distance * np.cos(azimuth) / m
+    dlng = distance * np.sin(azimuth) / (n * np.cos(lat))
+
+    lat_m = lat + dlat / 2
+    azimuth_m = azimuth + dlng / 2 * np.sin(lat_m)
+    m, n = _radii(lat_m)
+    return (lat + distance * np.cos(azimuth_m) / m,
+            lng + distance * np.sin(azimuth_m) / (n * np.cos(lat_m)))
+
+
+def local_distance(lat, lng, lat0, lng0):
+    # Distance in metres from (lat0, lng0) using a local projection around
+    # the mid latitude; good to centimetres over a few kilometres.
+    lat_m = (lat + lat0) / 2
+    m, n = _radii(lat_m)
+    return np.hypot((lat - lat0) * m, (lng - lng0) * n * np.cos(lat_m))
+
+
+def hex_cover(lat, lng, radius, step=HEX_DISTANCE):
+    """Returns (lats, lngs) in degrees of the hexagonal scan cover of a circle.
+
+    Ring i has 6 * i points, each one hop away from a point of ring i - 1,
+    exactly like the original walk with Geodesic.WGS84.Direct. Every ring is
+    computed in one vectorized step.
+    """
+    lat0, lng0 = math.radians(lat), math.radians(lng)
+    ring_lat, ring_lng = np.array([lat0]), np.array([lng0])
+    lats, lngs = [np.array([lat])], [np.array([lng])]
+
+    i = 1
+    while True:
+        j = np.arange(6 * i)
+        parents = j - j // i - 1 + (j % i == 0)
+        azimuth = np.radians((j + i - 1) // i * 60.0)
+
+        ring_lat, ring_lng = direct(ring_lat[parents], ring_lng[parents], azimuth, step)
+        in_range = local_distance(ring_lat, ring_lng, lat0, lng0) < radius
+        if not in_range.any():
+            break
+
+        lats.append(np.degrees(ring_lat[in_range]))
+        lngs.append(np.degrees(ring_lng[in_range]))
+        i += 1
+
+    return np.concatenate(lats), np.concatenate(lngs)
+
+
+def build_cover(scan_locations):
+    """Returns (cover, stats) for a list of scan locations.
+
+    cover is a list of {'lat', 'lng'} dicts, stats contains the number of
+    points and the time it took to build the cover.
+    """
+    start = time.time()
+    cover = []
+    for scan_location in scan_locations:
+        lats, lngs = hex_cover(scan_location['latitude'],
+                               scan_location['longitude'],
+                               scan_location['radius'])
+        cover.extend({'lat': p[0], 'lng': p[1]} for p in zip(lats.tolist(), lngs.tolist()))
+
+    stats = {'points': len(cover), 'build_time': time.time() - start}
+    log.info('Built cover with {} points in {:.3f}s'.format(stats['points'], stats['build_time']))
+    return cover, stats
+
+
+def nearest(lats, lngs, point_lats, point_lngs):
+    """Returns the index of the nearest point and its distance in metres for
+    every (lat, lng) in degrees."""
+    point_lats, point_lngs = np.radians(point_lats), np.radians(point_lngs)
+    indices = np.empty(len(lats), dtype=np.int64)
+    distances = np.empty(len(lats))
+    for i, (lat, lng) in enumerate(zip(np.radians(lats), np.radians(lngs))):
+        d = local_distance(point_lats, point_lngs, lat, lng)
+        indices[i] = np.argmin(d)
+        distances[i] = d[indices[i]]
+    return indices, distances
+
+
+def spawnpoint_cover(lats, lngs, radius=SCAN_RADIUS):
+    """Returns the indices of a small set of points (in degrees) so that every
+    point is within radius of one of them.
+
+    Greedy set cover with lazy re-evaluation: the candidate reaching the
+    most uncovered points is chosen until all are covered. Candidates are
+    the points themselves.
+    """
+    lats, lngs = np.radians(lats), np.radians(lngs)
+    m, n = _radii(lats.mean())
+    ys = (lats - lats.mean()) * m
+    xs = (lngs - lngs.mean()) * n * np.cos(lats.mean())
+
+    cells = {}
+    for i, cell in enumerate(zip(np.floor(xs / radius).astype(int).tolist(),
+                                 np.floor(ys / radius).astype(int).tolist())):
+        cells.setdefault(cell, []).append(i)
+
+    neighbours = [None] * len(lats)
+    for (cx, cy), members in cells.iteritems():
+        candidates = np.array([j for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                               for j in cells.get((cx + dx, cy + dy), ())])
+        for i in members:
+            in_range = np.hypot(xs[candidates] - xs[i], ys[candidates] - ys[i]) <= radius
+            neighbours[i] = set(candidates[in_range].tolist())
+
+    uncovered = set(xrange(len(lats)))
+    heap = [(-len(neighbours[i]), i) for i in xrange(len(lats))]
+    heapq.heapify(heap)
+    chosen = []
+    while uncovered:
+        gain, i = heapq.heappop(heap)
+        actual = len(neighbours[i] & uncovered)
+        if heap and actual < -heap[0][0]:
+            heapq.heappush(heap, (-actual, i))
+            continue
+        chosen.append(i)
+        uncovered -= neighbours[i]
+    return chosen
+
+
+def build_spawnpoint_cover(scan_locations, spawnpoints, hex_points):
+    """Returns (cover, stats) of the spawnpoints within the scan locations,
+    or (None, None) if none are known there.
+
+    spawnpoints is a list of (lat, lng); stats compare the number of points
+    to the hex_points of the full cover.
+    """
+    start = time.time()
+    if not spawnpoints or not scan_locations:
+        return None, None
+
+    lats = np.array([s[0] for s in spawnpoints])
+    lngs = np.array([s[1] for s in spawnpoints])
+    in_area = np.zeros(len(spawnpoints), dtype=bool)
+    for scan_location in scan_locations:
+        in_area |= local_distance(np.radians(lats), np.radians(lngs),
+                                  math.radians(scan_location['latitude']),
+                                  math.radians(scan_location['longitude'])) <= scan_location['radius']
+    if not in_area.any():
+        return None, None
+
+    lats, lngs = lats[in_area], lngs[in_area]
+    cover = [{'lat': float(lats[i]), 'lng': float(lngs[i])} for i in spawnpoint_cover(lats, lngs)]
+
+    stats = {'points': len(cover), 'hex_points': hex_points,
+             'spawnpoints': len(lats), 'build_time': time.time() - start}
+    log.info('Built spawnpoint cover with {} points for {} spawnpoints in {:.3f}s '
+             '({:.0%} of the {} hex cover points)'.format(
+                 stats['points'], stats['spawnpoints'], stats['build_time'],
+                 float(stats['points']) / max(hex_points, 1), hex_points))
+    return cover, stats
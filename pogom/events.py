@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+from threading import Lock
+from Queue import Queue, Full, Empty
+
+log = logging.getLogger(__name__)
+
+
+class EventClient(object):
+    def __init__(self, max_buffer):
+        self.queue = Queue(max_buffer)
+        self.dropped = False
+
+    def get(self, timeout):
+        """Returns the next message or None after timeout seconds."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+
+class Broadcaster(object):
+    """Fans server-sent events out to all connected clients.
+
+    Every event is formatted once and put into each client's bounded
+    buffer. A client whose buffer is full is dropped; its stream ends and
+    the browser reconnects and catches up.
+    """
+
+    def __init__(self, max_buffer=256):
+        self.max_buffer = max_buffer
+        self._lock = Lock()
+        self._clients = set()
+
+    def subscribe(self):
+        client = EventClient(self.max_buffer)
+        with self._lock:
+            self._clients.add(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def num_clients(self):
+        return len(self._clients)
+
+    def publish(self, event, data):
+        message = 'event: {}\ndata: {}\n\n'.format(event, data)
+        with self._lock:
+            clients = list(self._clients)
+
+        for client in clients:
+            try:
+                client.queue.put_nowait(message)
+            except Full:
+                log.info('Dropping slow event stream client.')
+                client.dropped = True
+                self.unsubscribe(client)
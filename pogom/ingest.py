@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from threading import Thread
+from Queue import Queue, Empty
+
+from .models import db, bulk_upsert, bulk_upsert_cell_timestamps, delete_forts, \
+    Pokemon, PokemonStats, HeatmapCell, SpawnpointSecond, Pokestop, Gym
+
+log = logging.getLogger(__name__)
+
+
+class IngestWriter(Thread):
+    """Single database writer for parsed map objects.
+
+    Scan workers put() the rows of a response into a bounded queue. The
+    writer merges rows of many responses and commits them in one
+    transaction once max_rows rows are pending or max_latency seconds have
+    passed since the first pending row. The current timestamps of the
+    scanned cells are committed with their rows. Listeners are called with
+    the merged rows and deleted fort ids after every commit, failure
+    listeners with the ids of the cells of a batch that wasn't written.
+    """
+
+    def __init__(self, max_rows=500, max_latency=1.0, max_pending=100):
+        Thread.__init__(self)
+        self.daemon = True
+        self.name = 'ingest_thread'
+
+        self.max_rows = max_rows
+        self.max_latency = max_latency
+
+        self._queue = Queue(max_pending)
+        self._listeners = []
+        self._failure_listeners = []
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def add_failure_listener(self, listener):
+        self._failure_listeners.append(listener)
+
+    def put(self, pokemons, pokestops, gyms, cell_timestamps=None, deleted=None):
+        # Blocks when the writer falls behind, throttling the scan workers
+        self._queue.put((pokemons, pokestops, gyms, cell_timestamps or {}, deleted or set()))
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def run(self):
+        while True:
+            batch = ({}, {}, {}, {}, set())
+            num_rows = self._merge(batch, self._queue.get())
+
+            deadline = time.time() + self.max_latency
+            while num_rows < self.max_rows:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    num_rows += self._merge(batch, self._queue.get(timeout=timeout))
+                except Empty:
+                    break
+
+            try:
+                self.flush(*batch)
+            except Exception as e:  # never let the writer die
+                log.error('Could not write {} rows: {}'.format(num_rows, e))
+                for listener in self._failure_listeners:
+                    try:
+                        listener(list(batch[3]))
+                    except Exception as e:
+                        log.error('Ingest failure listener failed: {}'.format(e))
+
+    @staticmethod
+    def _merge(batch, rows):
+        num_rows = 0
+        for merged, new in zip(batch, rows):
+            merged.update(new)
+            num_rows += len(new)
+        return num_rows
+
+    def flush(self, pokemons, pokestops, gyms, cell_timestamps=None, deleted=None):
+        deleted = deleted or set()
+        with db.atomic():
+            if pokemons:
+                log.info("Upserting {} pokemon".format(len(pokemons)))
+                new_pokemons = Pokemon.new_encounters(pokemons)
+                bulk_upsert(Pokemon, pokemons)
+                PokemonStats.add(new_pokemons)
+                HeatmapCell.add(new_pokemons)
+                SpawnpointSecond.add(new_pokemons)
+
+            if pokestops:
+                log.info("Upserting {} pokestops".format(len(pokestops)))
+                bulk_upsert(Pokestop, pokestops)
+
+            if gyms:
+                log.info("Upserting {} gyms".format(len(gyms)))
+                bulk_upsert(Gym, gyms)
+
+            if deleted:
+                log.info("Deleting {} forts".format(len(deleted)))
+                delete_forts(deleted)
+
+            if cell_timestamps:
+                bulk_upsert_cell_timestamps(cell_timestamps)
+
+        for listener in self._listeners:
+            try:
+                listener(pokemons, pokestops, gyms, deleted)
+            except Exception as e:
+                log.error('Ingest listener failed: {}'.format(e))
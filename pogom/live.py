@@ -0,0 +1,268 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+import math
+import time
+from collections import deque
+from datetime import datetime
+from threading import Lock
+
+from .models import Pokemon, Pokestop, Gym
+from .utils import get_pokemon_name
+
+log = logging.getLogger(__name__)
+
+
+def _row_dict(row):
+    return dict(zip(row._fields, row))
+
+
+class SpatialGrid(object):
+    """Buckets keys into cells of cell_size degrees for bounding box queries."""
+
+    def __init__(self, cell_size=0.01):
+        self.cell_size = cell_size
+        self._cells = {}
+
+    def _cell(self, lat, lng):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lng / self.cell_size))
+
+    def add(self, key, lat, lng):
+        self._cells.setdefault(self._cell(lat, lng), set()).add(key)
+
+    def remove(self, key, lat, lng):
+        cell = self._cell(lat, lng)
+        keys = self._cells.get(cell)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._cells[cell]
+
+    def query(self, sw_lat, sw_lng, ne_lat, ne_lng):
+        if sw_lng > ne_lng:  # viewport crosses the antimeridian
+            return (self.query(sw_lat, sw_lng, ne_lat, 180.0) +
+                    self.query(sw_lat, -180.0, ne_lat, ne_lng))
+
+        min_row, min_col = self._cell(sw_lat, sw_lng)
+        max_row, max_col = self._cell(ne_lat, ne_lng)
+        keys = []
+        if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self._cells):
+            # Zoomed out, cheaper to check every occupied cell
+            for (row, col), cell_keys in self._cells.iteritems():
+                if min_row <= row <= max_row and min_col <= col <= max_col:
+                    keys.extend(cell_keys)
+        else:
+            for row in xrange(min_row, max_row + 1):
+                for col in xrange(min_col, max_col + 1):
+                    keys.extend(self._cells.get((row, col), ()))
+        return keys
+
+
+def in_bounds(item, bounds):
+    sw_lat, sw_lng, ne_lat, ne_lng = bounds
+    if not sw_lat <= item['latitude'] <= ne_lat:
+        return False
+    if sw_lng > ne_lng:
+        return item['longitude'] >= sw_lng or item['longitude'] <= ne_lng
+    return sw_lng <= item['longitude'] <= ne_lng
+
+
+class LiveCollection(object):
+    """Items of one kind with their spatial index and change sequence.
+
+    Every stored item remembers the sequence number of its last change.
+    Removals are kept as (seq, key) tombstones; once the oldest tombstone
+    is dropped, deltas older than `horizon` can't be answered anymore.
+    """
+
+    def __init__(self, max_tombstones=10000):
+        self.items = {}
+        self.seqs = {}
+        self.grid = SpatialGrid()
+        self.tombstones = deque()
+        self.max_tombstones = max_tombstones
+        self.horizon = 0
+
+    def set(self, key, item, seq):
+        old = self.items.get(key)
+        if old == item:
+            return old
+        if old is not None:
+            self.grid.remove(key, old['latitude'], old['longitude'])
+        self.items[key] = item
+        self.seqs[key] = seq
+        self.grid.add(key, item['latitude'], item['longitude'])
+        return old
+
+    def remove(self, key, seq):
+        item = self.items.pop(key)
+        del self.seqs[key]
+        self.grid.remove(key, item['latitude'], item['longitude'])
+
+        if len(self.tombstones) >= self.max_tombstones:
+            self.horizon = self.tombstones.popleft()[0]
+        self.tombstones.append((seq, key))
+
+    def query(self, bounds=None, since=None):
+        if bounds is None:
+            keys = self.items.iterkeys()
+        else:
+            keys = (key for key in self.grid.query(*bounds) if in_bounds(self.items[key], bounds))
+
+        if since is None:
+            return [self.items[key] for key in keys]
+        return [self.items[key] for key in keys if self.seqs[key] > since]
+
+    def removed_since(self, since):
+        return [key for seq, key in self.tombstones if seq > since]
+
+
+class LiveState(object):
+    """Current map state kept in memory and fed by the ingest writer.
+
+    Active pokemon are indexed by encounter id and expired through a heap
+    ordered by disappear time, forts are kept by id. Everything is also
+    indexed in a spatial grid for viewport queries. /map-data is answered
+    from here, the database only keeps the history.
+
+    Every change increments `seq`, so clients can ask for the changes since
+    the sequence number of their last response. The sequence starts at the
+    current time in ms, so numbers handed out before a restart are older.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._expiry = []  # (disappear_time, encounter_id), may hold stale entries
+        self.seq = int(time.time() * 1000)
+        self._start_seq = self.seq
+
+        self._pokemons = LiveCollection()
+        self._pokestops = LiveCollection()
+        self._gyms = LiveCollection()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """listener(seq, changes) is called with the changed and removed items.
+
+        Listeners are called in seq order with the state locked, so they
+        must not block or call back into the live state.
+        """
+        self._listeners.append(listener)
+
+    def load(self):
+        with self._lock:
+            now = datetime.utcnow()
+            for p in Pokemon.select().where(Pokemon.disappear_time > now).dicts():
+                self._add_pokemon(p)
+            for f in Pokestop.select().dicts():
+                self._pokestops.set(f['pokestop_id'], f, self.seq)
+            for f in Gym.select().dicts():
+                self._gyms.set(f['gym_id'], f, self.seq)
+
+        log.info('Loaded {} active pokemon, {} pokestops and {} gyms'.format(
+            len(self._pokemons.items), len(self._pokestops.items), len(self._gyms.items)))
+
+    def update(self, pokemons, pokestops, gyms, deleted=()):
+        changes = {'pokemons': [], 'pokestops': [], 'gyms': []}
+        removed = {}
+        with self._lock:
+            self.seq += 1
+            for row in pokemons.itervalues():
+                p = _row_dict(row)
+                if self._add_pokemon(p):
+                    changes['pokemons'].append(p)
+            for row in pokestops.itervalues():
+                f = _row_dict(row)
+                if self._pokestops.set(row.pokestop_id, f, self.seq) != f:
+                    changes['pokestops'].append(f)
+            for row in gyms.itervalues():
+                f = _row_dict(row)
+                if self._gyms.set(row.gym_id, f, self.seq) != f:
+                    changes['gyms'].append(f)
+            for fort_id in deleted:
+                for name, collection in (('pokestops', self._pokestops), ('gyms', self._gyms)):
+                    if fort_id in collection.items:
+                        collection.remove(fort_id, self.seq)
+                        removed.setdefault(name, []).append(fort_id)
+            expired = self._expire(datetime.utcnow())
+
+            if expired:
+                removed['pokemons'] = expired
+            if removed:
+                changes['removed'] = removed
+            self._notify(self.seq, changes)
+
+    def _notify(self, seq, changes):
+        # Called with the lock held, so listeners see the changes in seq order
+        if not any(changes.itervalues()):
+            return
+        for listener in self._listeners:
+            try:
+                listener(seq, changes)
+            except Exception as e:
+                log.error('Live state listener failed: {}'.format(e))
+
+    def _add_pokemon(self, p):
+        old = self._pokemons.set(p['encounter_id'], p, self.seq)
+        if old is None or old['disappear_time'] != p['disappear_time']:
+            heapq.heappush(self._expiry, (p['disappear_time'], p['encounter_id']))
+        return old != p
+
+    def _expire(self, now):
+        expiry = self._expiry
+        expired = []
+        while expiry and expiry[0][0] <= now:
+            disappear_time, encounter_id = heapq.heappop(expiry)
+            p = self._pokemons.items.get(encounter_id)
+            if p is not None and p['disappear_time'] == disappear_time:
+                if not expired:
+                    self.seq += 1
+                self._pokemons.remove(encounter_id, self.seq)
+                expired.append(encounter_id)
+        return expired
+
+    def expire(self):
+        with self._lock:
+            expired = self._expire(datetime.utcnow())
+            if expired:
+                self._notify(self.seq, {'removed': {'pokemons': expired}})
+
+    def _is_valid_since(self, since, collection):
+        return (since is not None and max(self._start_seq, collection.horizon) <= since <= self.seq)
+
+    def get_map_data(self, bounds=None, since=None, pokemons=True, pokestops=False, gyms=True):
+        """Returns the requested items and the current sequence number.
+
+        If `since` is a valid sequence number only items changed after it
+        are returned, together with the keys of removed items. Otherwise
+        the result is a full snapshot ('full' is True).
+        """
+        collections = [(name, collection) for name, collection, wanted in (
+            ('pokemons', self._pokemons, pokemons),
+            ('pokestops', self._pokestops, pokestops),
+            ('gyms', self._gyms, gyms)) if wanted]
+
+        d = {}
+        with self._lock:
+            expired = self._expire(datetime.utcnow())
+            if expired:
+                self._notify(self.seq, {'removed': {'pokemons': expired}})
+
+            full = not all(self._is_valid_since(since, c) for _, c in collections)
+            if full:
+                since = None
+            else:
+                d['removed'] = dict((name, c.removed_since(since)) for name, c in collections)
+
+            for name, collection in collections:
+                d[name] = collection.query(bounds, since)
+            d['seq'] = self.seq
+            d['full'] = full
+
+        if pokemons:
+            d['pokemons'] = [dict(p) for p in d['pokemons']]
+            for p in d['pokemons']:
+                p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
+        return d
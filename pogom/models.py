@@ -2,13 +2,14 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import operator
 import random
 import math
 from peewee import Model, SqliteDatabase, InsertQuery, IntegerField, \
-    CharField, FloatField, BooleanField, DateTimeField, fn, SQL
+    CharField, FloatField, BooleanField, DateTimeField, BigIntegerField, CompositeKey, Clause, fn, SQL
 from datetime import datetime
 from base64 import b64encode
-import threading
+from collections import namedtuple
 
 from .utils import get_pokemon_name, get_args
 from playhouse.db_url import connect
@@ -26,7 +27,6 @@ else:
     ))
 
 log = logging.getLogger(__name__)
-lock = threading.Lock()
 
 
 class BaseModel(Model):
@@ -37,6 +37,43 @@ class BaseModel(Model):
     def get_all(cls):
         return [m for m in cls.select().dicts()]
 
+    @classmethod
+    def add_rows(cls, rows, merge=None):
+        """Adds the rows of new sightings to the stored rows of an aggregate.
+
+        A stored row with the same primary key is folded into the new one by
+        merge(row, old), which adds up the counts by default. Has to run in
+        the writing transaction.
+        """
+        key_fields = cls._meta.get_primary_key_fields()
+        rows = dict((tuple(row[f.name] for f in key_fields), row) for row in rows)
+        keys = rows.keys()
+        for i in xrange(0, len(keys), 100):
+            chunk = keys[i:i + 100]
+            if len(key_fields) == 1:
+                clause = key_fields[0] << [key[0] for key in chunk]
+            else:
+                # Flat OR, nested ones overflow the parser of sqlite
+                clause = Clause(*[reduce(operator.and_, [f == v for f, v in zip(key_fields, key)])
+                                  for key in chunk], glue=' OR ', parens=True)
+            for old in cls.select().where(clause).dicts():
+                row = rows[tuple(old[f.name] for f in key_fields)]
+                if merge is None:
+                    row['count'] += old['count']
+                else:
+                    merge(row, old)
+            InsertQuery(cls, rows=[rows[key] for key in chunk]).upsert().execute()
+
+    @classmethod
+    def replace_rows(cls, rows):
+        """Replaces all rows, used to rebuild an aggregate."""
+        rows = list(rows)
+        with db.atomic():
+            cls.delete().execute()
+            for i in xrange(0, len(rows), 100):
+                InsertQuery(cls, rows=rows[i:i + 100]).execute()
+        return rows
+
 
 class Pokemon(BaseModel):
     # We are base64 encoding the ids delivered by the api
@@ -62,41 +99,200 @@ class Pokemon(BaseModel):
 
         return pokemons
 
+    @classmethod
+    def new_encounters(cls, pokemons):
+        """Returns the rows of `pokemons` that are not in the database yet."""
+        # The dict is keyed by the raw ids, the table stores the encoded ones
+        encounter_ids = [row.encounter_id for row in pokemons.itervalues()]
+        known = set()
+        step = 500
+        for i in xrange(0, len(encounter_ids), step):
+            query = (Pokemon
+                     .select(Pokemon.encounter_id)
+                     .where(Pokemon.encounter_id << encounter_ids[i:i + step])
+                     .tuples())
+            known.update(encounter_id for encounter_id, in query)
+
+        return [row for row in pokemons.itervalues() if row.encounter_id not in known]
+
+
+class PokemonStats(BaseModel):
+    """Number of sightings and first/last disappear time of every species.
+
+    Kept up to date by the ingest writer, so /stats doesn't have to
+    aggregate the whole pokemon history.
+    """
+    pokemon_id = IntegerField(primary_key=True)
+    count = IntegerField()
+    first_seen = DateTimeField()
+    last_seen = DateTimeField()
+
     @classmethod
     def get_stats(cls):
-        query = (Pokemon
-                 .select(Pokemon.pokemon_id, fn.COUNT(Pokemon.pokemon_id).alias('count'), fn.MAX(Pokemon.disappear_time).alias('lastseen'))
-                 .group_by(Pokemon.pokemon_id)
-                 .order_by(-SQL('count'))
+        query = (PokemonStats
+                 .select(PokemonStats.pokemon_id, PokemonStats.count,
+                         PokemonStats.last_seen.alias('lastseen'))
+                 .order_by(-PokemonStats.count)
                  .dicts())
 
         pokemons = list(query)
 
-        known_pokemon = set( p['pokemon_id'] for p in query )
-        unknown_pokemon = set(range(1,151)).difference(known_pokemon)
-        pokemons.extend( { 'pokemon_id': i, 'count': 0, 'lastseen': None } for i in unknown_pokemon)
+        known_pokemon = set(p['pokemon_id'] for p in pokemons)
+        unknown_pokemon = set(range(1, 151)).difference(known_pokemon)
+        pokemons.extend({'pokemon_id': i, 'count': 0, 'lastseen': None} for i in unknown_pokemon)
 
         for p in pokemons:
             p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
         return pokemons
 
+    @staticmethod
+    def _merge(row, old):
+        row['count'] += old['count']
+        row['first_seen'] = min(row['first_seen'], old['first_seen'])
+        row['last_seen'] = max(row['last_seen'], old['last_seen'])
+
     @classmethod
-    def get_heat_stats(cls):
+    def add(cls, pokemons):
+        """Counts new sightings."""
+        stats = {}
+        for p in pokemons:
+            row = {'pokemon_id': p.pokemon_id, 'count': 1,
+                   'first_seen': p.disappear_time, 'last_seen': p.disappear_time}
+            if p.pokemon_id in stats:
+                cls._merge(row, stats[p.pokemon_id])
+            stats[p.pokemon_id] = row
+        cls.add_rows(stats.itervalues(), merge=cls._merge)
+
+    @classmethod
+    def rebuild(cls):
         query = (Pokemon
-                 .select(Pokemon.pokemon_id, fn.COUNT(Pokemon.pokemon_id).alias('count'), Pokemon.latitude, Pokemon.longitude)
-                 .group_by(Pokemon.latitude, Pokemon.longitude, Pokemon.pokemon_id)
-                 .order_by(-SQL('count'))
+                 .select(Pokemon.pokemon_id, fn.COUNT(Pokemon.pokemon_id).alias('count'),
+                         fn.MIN(Pokemon.disappear_time).alias('first_seen'),
+                         fn.MAX(Pokemon.disappear_time).alias('last_seen'))
+                 .group_by(Pokemon.pokemon_id)
                  .dicts())
+        rows = cls.replace_rows(query)
+        log.info('Rebuilt pokemon stats of {} species'.format(len(rows)))
 
-        pokemons = list(query)
 
-        known_pokemon = set(p['pokemon_id'] for p in query)
-        unknown_pokemon = set(range(1, 151)).difference(known_pokemon)
-        pokemons.extend({'pokemon_id': i, 'count': 0} for i in unknown_pokemon)
-        for p in pokemons:
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
+class HeatmapCell(BaseModel):
+    """Number of sightings of a species in a grid cell.
+
+    Sightings are counted in grids of several resolutions (SIZES, in
+    degrees) so a heatmap of any zoom level only reads a few cells.
+    Kept up to date by the ingest writer.
+    """
+    SIZES = [0.0005, 0.002, 0.008, 0.032, 0.128]
+    MAX_CELL_PIXELS = 8
+
+    level = IntegerField()
+    pokemon_id = IntegerField()
+    lat_index = IntegerField()
+    lng_index = IntegerField()
+    count = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey('level', 'pokemon_id', 'lat_index', 'lng_index')
+
+    @classmethod
+    def _cells(cls, pokemons):
+        cells = {}
+        for pokemon_id, lat, lng in pokemons:
+            for level, size in enumerate(cls.SIZES):
+                key = (level, pokemon_id, int(math.floor(lat / size)), int(math.floor(lng / size)))
+                cells[key] = cells.get(key, 0) + 1
+        return [dict(zip(('level', 'pokemon_id', 'lat_index', 'lng_index', 'count'), key + (count,)))
+                for key, count in cells.iteritems()]
+
+    @classmethod
+    def add(cls, pokemons):
+        """Counts new sightings."""
+        cls.add_rows(cls._cells((p.pokemon_id, p.latitude, p.longitude) for p in pokemons))
+
+    @classmethod
+    def rebuild(cls):
+        query = Pokemon.select(Pokemon.pokemon_id, Pokemon.latitude, Pokemon.longitude).tuples()
+        rows = cls.replace_rows(cls._cells(query.iterator()))
+        log.info('Rebuilt heatmap with {} cells'.format(len(rows)))
+
+    @classmethod
+    def level_for_zoom(cls, zoom):
+        """Coarsest level whose cells are at most MAX_CELL_PIXELS wide at zoom."""
+        degrees_per_pixel = 360.0 / (256 * 2 ** zoom)
+        level = 0
+        for i, size in enumerate(cls.SIZES):
+            if size / degrees_per_pixel <= cls.MAX_CELL_PIXELS:
+                level = i
+        return level
+
+    @classmethod
+    def get_heatmap(cls, pokemon_ids, bounds=None, zoom=None):
+        level = 0 if zoom is None else cls.level_for_zoom(zoom)
+        size = cls.SIZES[level]
+
+        query = (HeatmapCell
+                 .select()
+                 .where((HeatmapCell.level == level) &
+                        (HeatmapCell.pokemon_id << pokemon_ids)))
+
+        if bounds is not None:
+            sw_lat, sw_lng, ne_lat, ne_lng = [int(math.floor(b / size)) for b in bounds]
+            query = query.where(HeatmapCell.lat_index.between(sw_lat, ne_lat))
+            if sw_lng > ne_lng:  # viewport crosses the antimeridian
+                query = query.where((HeatmapCell.lng_index >= sw_lng) | (HeatmapCell.lng_index <= ne_lng))
+            else:
+                query = query.where(HeatmapCell.lng_index.between(sw_lng, ne_lng))
+
+        return [{'pokemon_id': c.pokemon_id,
+                 'latitude': (c.lat_index + 0.5) * size,
+                 'longitude': (c.lng_index + 0.5) * size,
+                 'count': c.count} for c in query]
+
+
+class SpawnpointSecond(BaseModel):
+    """Number of pokemon seen at a spawnpoint per spawn second of the hour.
+
+    Kept up to date by the ingest writer, so spawnpoints are learned
+    without reading the pokemon history.
+    """
+    SPAWN_DURATION = 15 * 60  # pokemon stay for 15 minutes
+
+    spawnpoint_id = CharField()
+    spawn_second = IntegerField()
+    latitude = FloatField()
+    longitude = FloatField()
+    count = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey('spawnpoint_id', 'spawn_second')
+
+    @classmethod
+    def _seconds(cls, pokemons):
+        seconds = {}
+        for spawnpoint_id, lat, lng, disappear_time in pokemons:
+            second = (disappear_time.minute * 60 + disappear_time.second - cls.SPAWN_DURATION) % 3600
+            key = (spawnpoint_id, second)
+            if key in seconds:
+                seconds[key]['count'] += 1
+            else:
+                seconds[key] = {'spawnpoint_id': spawnpoint_id, 'spawn_second': second,
+                                'latitude': lat, 'longitude': lng, 'count': 1}
+        return seconds.values()
+
+    @classmethod
+    def add(cls, pokemons):
+        """Counts new sightings."""
+        cls.add_rows(cls._seconds((p.spawnpoint_id, p.latitude, p.longitude, p.disappear_time)
+                                  for p in pokemons))
+
+    @classmethod
+    def rebuild(cls):
+        query = (Pokemon
+                 .select(Pokemon.spawnpoint_id, Pokemon.latitude, Pokemon.longitude, Pokemon.disappear_time)
+                 .tuples())
+        rows = cls.replace_rows(cls._seconds(query.iterator()))
+        log.info('Rebuilt spawn seconds of {} spawnpoints'.format(len(set(r['spawnpoint_id'] for r in rows))))
 
-        return pokemons
 
 class Pokestop(BaseModel):
     pokestop_id = CharField(primary_key=True)
@@ -124,13 +320,140 @@ class Gym(BaseModel):
     last_modified = DateTimeField()
 
 
+class SchemaVersion(BaseModel):
+    """Version of derived tables, they are rebuilt when it's outdated."""
+    name = CharField(primary_key=True)
+    version = IntegerField()
+
+
+# Version 2: re-sightings were counted as new encounters before
+AGGREGATES_VERSION = 2
+
+
+class CellTimestamp(BaseModel):
+    """current_timestamp_ms of the last response of every S2 cell, sent as
+    since_timestamp_ms so the server only returns what changed."""
+    cell_id = CharField(primary_key=True)  # uint64 doesn't fit sqlite's integers
+    timestamp_ms = BigIntegerField()
+
+    @classmethod
+    def get_timestamps(cls):
+        return dict((long(cell_id), timestamp_ms) for cell_id, timestamp_ms in cls.select().tuples())
+
+
+PokemonRow = namedtuple('PokemonRow', [
+    'encounter_id', 'spawnpoint_id', 'pokemon_id', 'latitude', 'longitude',
+    'disappear_time'])
+PokestopRow = namedtuple('PokestopRow', [
+    'pokestop_id', 'enabled', 'latitude', 'longitude', 'last_modified',
+    'lure_expiration', 'active_pokemon_id'])
+GymRow = namedtuple('GymRow', [
+    'gym_id', 'team_id', 'guard_pokemon_id', 'gym_points', 'enabled',
+    'latitude', 'longitude', 'last_modified'])
+
+
 def parse_map(map_dict):
+    map_objects = map_dict['responses']['GET_MAP_OBJECTS']
+    if isinstance(map_objects, dict):
+        return parse_map_dict(map_objects)
+    return parse_map_objects(map_objects)
+
+
+def parse_map_cells(map_dict):
+    """Returns the current timestamp of every cell and the ids of deleted objects."""
+    map_objects = map_dict['responses']['GET_MAP_OBJECTS']
+    timestamps = {}
+    deleted = set()
+    if isinstance(map_objects, dict):
+        for cell in map_objects['map_cells']:
+            timestamps[cell['s2_cell_id']] = cell.get('current_timestamp_ms', 0)
+            deleted.update(cell.get('deleted_objects', ()))
+    else:
+        for cell in map_objects.map_cells:
+            timestamps[cell.s2_cell_id] = cell.current_timestamp_ms
+            deleted.update(cell.deleted_objects)
+    return timestamps, deleted
+
+
+def parse_map_objects(map_objects):
+    """Extracts the rows directly from a GetMapObjectsResponse message."""
+    pokemons = {}
+    pokestops = {}
+    gyms = {}
+    utcfromtimestamp = datetime.utcfromtimestamp
+
+    # With since_timestamp_ms empty cells are normal, but every cell has
+    # its current timestamp
+    cells = map_objects.map_cells
+    if not cells or not all(cell.current_timestamp_ms for cell in cells):
+        log.warning("Received valid response but without any data. Possibly rate-limited?")
+
+    for cell in cells:
+        for p in cell.wild_pokemons:
+            encounter_id = p.encounter_id
+            if encounter_id in pokemons:
+                continue  # prevent unnecessary parsing
+
+            time_till_hidden_ms = p.time_till_hidden_ms
+            if 0 < time_till_hidden_ms <= 900000:
+                disappear_time = utcfromtimestamp(
+                    (p.last_modified_timestamp_ms + time_till_hidden_ms) / 1000.0)
+            else:
+                disappear_time = utcfromtimestamp(
+                    p.last_modified_timestamp_ms / 1000 + 15 * 60)
+
+            pokemons[encounter_id] = PokemonRow(
+                b64encode(str(encounter_id)), p.spawn_point_id,
+                p.pokemon_data.pokemon_id, p.latitude, p.longitude,
+                disappear_time)
+
+        for p in cell.catchable_pokemons:
+            encounter_id = p.encounter_id
+            if encounter_id in pokemons:
+                continue  # prevent unnecessary parsing
+
+            log.critical("found catchable pokemon not in wild: {}".format(p))
+
+            pokemons[encounter_id] = PokemonRow(
+                b64encode(str(encounter_id)), p.spawn_point_id, p.pokemon_id,
+                p.latitude, p.longitude,
+                utcfromtimestamp(p.expiration_timestamp_ms / 1000.0))
+
+        for f in cell.forts:
+            fort_id = f.id
+            if fort_id in gyms or fort_id in pokestops:
+                continue  # prevent unnecessary parsing
+
+            if f.type == 1:  # Pokestops
+                if f.HasField('lure_info'):
+                    lure_expiration = utcfromtimestamp(
+                        f.lure_info.lure_expires_timestamp_ms / 1000.0)
+                    active_pokemon_id = f.lure_info.active_pokemon_id
+                else:
+                    lure_expiration, active_pokemon_id = None, None
+
+                pokestops[fort_id] = PokestopRow(
+                    fort_id, f.enabled, f.latitude, f.longitude,
+                    utcfromtimestamp(f.last_modified_timestamp_ms / 1000.0),
+                    lure_expiration, active_pokemon_id)
+
+            else:  # Currently, there are only stops and gyms
+                gyms[fort_id] = GymRow(
+                    fort_id, f.owned_by_team, f.guard_pokemon_id or None,
+                    f.gym_points, f.enabled, f.latitude, f.longitude,
+                    utcfromtimestamp(f.last_modified_timestamp_ms / 1000.0))
+
+    return pokemons, pokestops, gyms
+
+
+def parse_map_dict(map_objects):
+    """Same as parse_map_objects() for responses converted by protobuf_to_dict."""
     pokemons = {}
     pokestops = {}
     gyms = {}
 
-    cells = map_dict['responses']['GET_MAP_OBJECTS']['map_cells']
-    if sum(len(cell.keys()) for cell in cells) == len(cells) * 2:
+    cells = map_objects.get('map_cells', [])
+    if not cells or not all(cell.get('current_timestamp_ms') for cell in cells):
         log.warning("Received valid response but without any data. Possibly rate-limited?")
 
     for cell in cells:
@@ -138,36 +461,36 @@ def parse_map(map_dict):
             if p['encounter_id'] in pokemons:
                 continue  # prevent unnecessary parsing
 
-            pokemons[p['encounter_id']] = {
-                'encounter_id': b64encode(str(p['encounter_id'])),
-                'spawnpoint_id': p['spawn_point_id'],
-                'pokemon_id': p['pokemon_data']['pokemon_id'],
-                'latitude': p['latitude'],
-                'longitude': p['longitude'],
-                'disappear_time': datetime.utcfromtimestamp(
-                        (p['last_modified_timestamp_ms'] +
-                         p['time_till_hidden_ms']) / 1000.0)
-            }
-            if p['time_till_hidden_ms'] < 0 or p['time_till_hidden_ms'] > 900000:
-                pokemons[p['encounter_id']]['disappear_time'] = datetime.utcfromtimestamp(
+            time_till_hidden_ms = p.get('time_till_hidden_ms', 0)
+            if 0 < time_till_hidden_ms <= 900000:
+                disappear_time = datetime.utcfromtimestamp(
+                        (p['last_modified_timestamp_ms'] + time_till_hidden_ms) / 1000.0)
+            else:
+                disappear_time = datetime.utcfromtimestamp(
                         p['last_modified_timestamp_ms']/1000 + 15*60)
 
+            pokemons[p['encounter_id']] = PokemonRow(
+                encounter_id=b64encode(str(p['encounter_id'])),
+                spawnpoint_id=p['spawn_point_id'],
+                pokemon_id=p['pokemon_data']['pokemon_id'],
+                latitude=p['latitude'],
+                longitude=p['longitude'],
+                disappear_time=disappear_time)
+
         for p in cell.get('catchable_pokemons', []):
             if p['encounter_id'] in pokemons:
                 continue  # prevent unnecessary parsing
 
             log.critical("found catchable pokemon not in wild: {}".format(p))
 
-            pokemons[p['encounter_id']] = {
-                'encounter_id': b64encode(str(p['encounter_id'])),
-                'spawnpoint_id': p['spawn_point_id'],
-                'pokemon_id': p['pokemon_data']['pokemon_id'],
-                'latitude': p['latitude'],
-                'longitude': p['longitude'],
-                'disappear_time': datetime.utcfromtimestamp(
-                        (p['last_modified_timestamp_ms'] +
-                         p['time_till_hidden_ms']) / 1000.0)
-            }
+            pokemons[p['encounter_id']] = PokemonRow(
+                encounter_id=b64encode(str(p['encounter_id'])),
+                spawnpoint_id=p['spawn_point_id'],
+                pokemon_id=p['pokemon_id'],
+                latitude=p['latitude'],
+                longitude=p['longitude'],
+                disappear_time=datetime.utcfromtimestamp(
+                        p['expiration_timestamp_ms'] / 1000.0))
 
         for f in cell.get('forts', []):
             if f['id'] in gyms or f['id'] in pokestops:
@@ -181,56 +504,68 @@ def parse_map(map_dict):
                 else:
                     lure_expiration, active_pokemon_id = None, None
 
-                pokestops[f['id']] = {
-                    'pokestop_id': f['id'],
-                    'enabled': f['enabled'],
-                    'latitude': f['latitude'],
-                    'longitude': f['longitude'],
-                    'last_modified': datetime.utcfromtimestamp(
+                pokestops[f['id']] = PokestopRow(
+                    pokestop_id=f['id'],
+                    enabled=f['enabled'],
+                    latitude=f['latitude'],
+                    longitude=f['longitude'],
+                    last_modified=datetime.utcfromtimestamp(
                             f['last_modified_timestamp_ms'] / 1000.0),
-                    'lure_expiration': lure_expiration,
-                    'active_pokemon_id': active_pokemon_id
-                }
+                    lure_expiration=lure_expiration,
+                    active_pokemon_id=active_pokemon_id)
 
             else:  # Currently, there are only stops and gyms
-                gyms[f['id']] = {
-                    'gym_id': f['id'],
-                    'team_id': f.get('owned_by_team', 0),
-                    'guard_pokemon_id': f.get('guard_pokemon_id', None),
-                    'gym_points': f.get('gym_points', 0),
-                    'enabled': f['enabled'],
-                    'latitude': f['latitude'],
-                    'longitude': f['longitude'],
-                    'last_modified': datetime.utcfromtimestamp(
-                            f['last_modified_timestamp_ms'] / 1000.0),
-                }
+                gyms[f['id']] = GymRow(
+                    gym_id=f['id'],
+                    team_id=f.get('owned_by_team', 0),
+                    guard_pokemon_id=f.get('guard_pokemon_id', None),
+                    gym_points=f.get('gym_points', 0),
+                    enabled=f['enabled'],
+                    latitude=f['latitude'],
+                    longitude=f['longitude'],
+                    last_modified=datetime.utcfromtimestamp(
+                            f['last_modified_timestamp_ms'] / 1000.0))
 
-    with db.atomic() and lock:
-        if pokemons:
-            log.info("Upserting {} pokemon".format(len(pokemons)))
-            bulk_upsert(Pokemon, pokemons)
-
-        if pokestops:
-            log.info("Upserting {} pokestops".format(len(pokestops)))
-            bulk_upsert(Pokestop, pokestops)
-
-        if gyms:
-            log.info("Upserting {} gyms".format(len(gyms)))
-            bulk_upsert(Gym, gyms)
+    return pokemons, pokestops, gyms
 
 
 def bulk_upsert(cls, data):
-    num_rows = len(data.values())
+    rows = [dict(zip(row._fields, row)) for row in data.values()]
+    num_rows = len(rows)
     i = 0
     step = 100
 
     while i < num_rows:
         log.debug("Inserting items {} to {}".format(i, min(i + step, num_rows)))
-        InsertQuery(cls, rows=data.values()[i:min(i + step, num_rows)]).upsert().execute()
+        InsertQuery(cls, rows=rows[i:min(i + step, num_rows)]).upsert().execute()
         i += step
 
 
+def bulk_upsert_cell_timestamps(timestamps):
+    rows = [{'cell_id': str(cell_id), 'timestamp_ms': timestamp_ms}
+            for cell_id, timestamp_ms in timestamps.iteritems()]
+    for i in xrange(0, len(rows), 100):
+        InsertQuery(CellTimestamp, rows=rows[i:i + 100]).upsert().execute()
+
+
+def delete_forts(fort_ids):
+    fort_ids = list(fort_ids)
+    for i in xrange(0, len(fort_ids), 500):
+        Pokestop.delete().where(Pokestop.pokestop_id << fort_ids[i:i + 500]).execute()
+        Gym.delete().where(Gym.gym_id << fort_ids[i:i + 500]).execute()
+
+
 def create_tables():
     db.connect()
-    db.create_tables([Pokemon, Pokestop, Gym], safe=True)
+    aggregate_tables = [PokemonStats, HeatmapCell, SpawnpointSecond]
+    new_aggregates = [cls for cls in aggregate_tables if not cls.table_exists()]
+    db.create_tables([Pokemon, PokemonStats, HeatmapCell, SpawnpointSecond, Pokestop, Gym,
+                      CellTimestamp, SchemaVersion], safe=True)
+
+    aggregates = SchemaVersion.select().where(SchemaVersion.name == 'aggregates').first()
+    if aggregates is None or aggregates.version < AGGREGATES_VERSION:
+        new_aggregates = aggregate_tables
+    for cls in new_aggregates:
+        cls.rebuild()
+    SchemaVersion.insert(name='aggregates', version=AGGREGATES_VERSION).upsert().execute()
     db.close()
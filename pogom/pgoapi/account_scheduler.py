@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Scheduling of the accounts shared by the api workers."""
+
+import heapq
+import time
+from itertools import count
+from threading import Condition
+
+
+class AccountScheduler(object):
+    """Hands accounts to the workers once they may be used again.
+
+    Waiting accounts are kept in a heap ordered by the time they are ready
+    at. Workers block on a condition variable until the earliest one is
+    ready, so nobody spins over sidelined accounts and nobody sleeps while
+    holding one. Rescheduling a waiting account pushes a new heap entry and
+    invalidates the old one, which get skipped when they come up.
+
+    Accounts that are not ready to be used (e.g. while logging in) are held
+    out of the rotation until they are released.
+    """
+
+    def __init__(self):
+        self._cond = Condition()
+        self._heap = []
+        self._waiting = {}  # username -> [ready_at, seq, auth_provider]
+        self._in_use = {}  # username -> auth_provider, acquired or held
+        self._held = set()
+        self._removed = set()  # in use, dropped on release
+        self._seq = count()
+
+    def __len__(self):
+        return len(self._waiting) + len(self._in_use)
+
+    def __contains__(self, username):
+        return username in self._waiting or (username in self._in_use and username not in self._removed)
+
+    def num_ready(self):
+        """Number of accounts that are not held."""
+        with self._cond:
+            return len(self._waiting) + len(self._in_use) - len(self._held)
+
+    def _push(self, auth_provider, ready_at):
+        old = self._waiting.get(auth_provider.username)
+        if old is not None:
+            old[-1] = None
+        entry = [ready_at, next(self._seq), auth_provider]
+        self._waiting[auth_provider.username] = entry
+        heapq.heappush(self._heap, entry)
+        self._cond.notify()
+
+    def _head(self):
+        # Drops invalidated entries from the top of the heap
+        while self._heap and self._heap[0][-1] is None:
+            heapq.heappop(self._heap)
+        return self._heap[0] if self._heap else None
+
+    def add(self, auth_provider, ready_at=None, held=False):
+        with self._cond:
+            if auth_provider.username in self._removed:
+                self._removed.discard(auth_provider.username)  # not dropped after all
+                return False
+            if auth_provider.username in self:
+                return False
+            if held:
+                self._in_use[auth_provider.username] = auth_provider
+                self._held.add(auth_provider.username)
+            else:
+                self._push(auth_provider, ready_at or time.time())
+            return True
+
+    def remove(self, username):
+        with self._cond:
+            entry = self._waiting.pop(username, None)
+            if entry is not None:
+                entry[-1] = None
+            elif username in self._in_use:
+                self._removed.add(username)
+
+    def usernames(self):
+        with self._cond:
+            return set(self._waiting) | set(self._in_use)
+
+    def acquire(self, timeout=None):
+        """Returns the next ready account, blocks until there is one. Returns
+        None if timeout seconds passed first."""
+        end = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while True:
+                now = time.time()
+                head = self._head()
+                if head is not None and head[0] <= now:
+                    heapq.heappop(self._heap)
+                    auth_provider = head[-1]
+                    del self._waiting[auth_provider.username]
+                    self._in_use[auth_provider.username] = auth_provider
+                    return auth_provider
+
+                wait = head[0] - now if head is not None else None
+                if end is not None:
+                    if now >= end:
+                        return None
+                    wait = min(wait, end - now) if wait is not None else end - now
+                self._cond.wait(wait)
+
+    def hold(self, auth_provider):
+        """Keeps an acquired account out of the rotation until it's released."""
+        with self._cond:
+            if auth_provider.username in self._in_use:
+                self._held.add(auth_provider.username)
+
+    def release(self, auth_provider, ready_at):
+        """Gives an acquired or held account back, it's handed out again at
+        ready_at."""
+        with self._cond:
+            username = auth_provider.username
+            self._in_use.pop(username, None)
+            self._held.discard(username)
+            if username in self._removed:
+                self._removed.discard(username)
+                return
+            self._push(auth_provider, ready_at)
+
+    def sideline(self, username, until):
+        """Postpones a waiting account until the given time, O(log n)."""
+        with self._cond:
+            entry = self._waiting.get(username)
+            if entry is not None and entry[-1] is not None:
+                self._push(entry[-1], until)
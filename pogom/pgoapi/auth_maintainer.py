@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Background login and token refresh of the accounts."""
+
+import math
+import time
+import logging
+from threading import Lock, Thread
+
+from .account_scheduler import AccountScheduler
+from .pacing import AUTH_FAILED
+
+
+class AuthMaintainer(object):
+    """Logs accounts in off the request path.
+
+    New accounts and accounts whose access token expires soon are held out
+    of the rotation of the AccountScheduler and logged in by a small pool
+    of threads. They are released to the workers once they are logged in,
+    so a worker never waits for a login. Failed logins are retried with an
+    exponential backoff without blocking a thread in the meantime.
+
+    num_threads accounts log in at the same time, so adding many accounts
+    (at startup or when the accounts are changed) doesn't log them in one
+    after another.
+    """
+
+    REFRESH_AHEAD = 10 * 60
+    MAX_BACKOFF = 5 * 60
+
+    def __init__(self, accounts, pacing, num_threads=4):
+        self.log = logging.getLogger(__name__)
+
+        self._accounts = accounts
+        self._pacing = pacing
+        self._pending = AccountScheduler()
+        self._ready_at = {}
+        self._fails = {}
+        self._num_logins = 0
+        self._lock = Lock()  # guards _num_logins
+
+        for i in xrange(num_threads):
+            thread = Thread(target=self._run, name='auth_maintainer-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+
+    def needs_login(self, auth_provider, ready_at):
+        """True if the access token of the account is gone or expires soon
+        after ready_at."""
+        expiry = auth_provider._access_token_expiry
+        return not auth_provider.is_login() or (expiry and expiry < ready_at + self.REFRESH_AHEAD)
+
+    def login(self, auth_provider, ready_at=None):
+        """Logs a held account in and releases it to the workers at ready_at."""
+        self._ready_at[auth_provider.username] = ready_at or time.time()
+        self._pending.add(auth_provider)
+
+    def stats(self):
+        pending = [username for username in self._pending.usernames() if username in self._accounts]
+        return {'logging-in': len(pending),
+                'failing': len([username for username in pending if self._fails.get(username)]),
+                'logins': self._num_logins}
+
+    def _finish(self, auth_provider):
+        self._pending.remove(auth_provider.username)
+        self._pending.release(auth_provider, None)
+        self._fails.pop(auth_provider.username, None)
+        return self._ready_at.pop(auth_provider.username, 0)
+
+    def _run(self):
+        while True:
+            auth_provider = self._pending.acquire()
+            if auth_provider.username not in self._accounts:
+                self._finish(auth_provider)
+                self._accounts.release(auth_provider, None)  # drops the removed account
+                continue
+
+            if self._login(auth_provider):
+                with self._lock:
+                    self._num_logins += 1
+                ready_at = self._finish(auth_provider)
+                self._accounts.release(auth_provider, max(ready_at, time.time()))
+                continue
+
+            fails = self._fails[auth_provider.username] = self._fails.get(auth_provider.username, 0) + 1
+            if fails % 5 == 0:
+                self.log.error('Login failed {} times: {}'.format(fails, auth_provider.username))
+                self._pacing.report(auth_provider.username, AUTH_FAILED)
+            sleep_t = min(math.exp(fails / 1.7), self.MAX_BACKOFF)
+            self.log.info('Login failed, retrying in {:.2f} seconds'.format(sleep_t))
+            self._pending.release(auth_provider, time.time() + sleep_t)
+
+    def _login(self, auth_provider):
+        self.log.info('Attempting login: {}'.format(auth_provider.username))
+
+        # user_login keeps an access token that is still valid
+        auth_provider._login = False
+        auth_provider._access_token = None
+        try:
+            auth_provider.user_login()
+        except Exception as e:  # never let the thread die
+            self.log.info('Login of {} failed: {}'.format(auth_provider.username, e))
+            return False
+
+        if auth_provider.is_login():
+            self.log.info('Login successful: {}'.format(auth_provider.username))
+            return True
+        return False
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Request pacing driven by the health of the responses."""
+
+import time
+from collections import deque
+from threading import Lock
+
+HEALTHY = 'healthy'
+EMPTY = 'empty'  # empty map responses
+CODE_THREE = 'code-3'
+THROTTLED = 'throttled'  # status code 52
+AUTH_FAILED = 'auth-failed'
+
+
+class AccountPace(object):
+    def __init__(self, rate):
+        self.rate = rate  # requests per second
+        self.requests = 0
+        self.signals = {}
+
+
+class PacingController(object):
+    """AIMD pacing of the requests, per account and for the whole api.
+
+    Every account has a request rate that grows by RATE_INCREASE with each
+    healthy response and is multiplied by the BACKOFF factor of a problem
+    signal, between MIN_RATE and MAX_RATE. An account may be used again
+    1 / rate seconds after its last request.
+
+    Throttling hits the IP too, so a throttle signal also caps the rate of
+    all requests at BACKOFF[THROTTLED] times the rate of the last WINDOW
+    seconds. The cap grows by GLOBAL_RATE_INCREASE with each healthy
+    response and is lifted once it's above what the accounts can do anyway.
+    """
+
+    INITIAL_RATE = 1 / 10.0
+    MIN_RATE = 1 / 600.0
+    MAX_RATE = 1 / 5.0
+    RATE_INCREASE = 0.005
+    BACKOFF = {EMPTY: 0.7, CODE_THREE: 0.7, THROTTLED: 0.5, AUTH_FAILED: 0.25}
+
+    GLOBAL_RATE_INCREASE = 0.01
+    WINDOW = 60.0
+
+    def __init__(self):
+        self._lock = Lock()
+        self._accounts = {}
+        self._global_rate = None  # requests per second, None if unlimited
+        self._next_slot = 0
+        self._recent = deque()  # times of the requests in the last WINDOW seconds
+
+    def _pace(self, username):
+        pace = self._accounts.get(username)
+        if pace is None:
+            pace = self._accounts[username] = AccountPace(self.INITIAL_RATE)
+        return pace
+
+    def remove(self, username):
+        with self._lock:
+            self._accounts.pop(username, None)
+
+    def reserve(self):
+        """Reserves a slot for the next request, returns the seconds to wait
+        for it. Zero unless the global rate is capped."""
+        with self._lock:
+            now = time.time()
+            self._recent.append(now)
+            while self._recent[0] < now - self.WINDOW:
+                self._recent.popleft()
+
+            if self._global_rate is None:
+                return 0
+            start = max(now, self._next_slot)
+            self._next_slot = start + 1 / self._global_rate
+            return start - now
+
+    def report(self, username, signal):
+        with self._lock:
+            pace = self._pace(username)
+            pace.signals[signal] = pace.signals.get(signal, 0) + 1
+
+            if signal == HEALTHY:
+                pace.requests += 1
+                pace.rate = min(pace.rate + self.RATE_INCREASE, self.MAX_RATE)
+                if self._global_rate is not None:
+                    self._global_rate += self.GLOBAL_RATE_INCREASE
+                    if self._global_rate >= len(self._accounts) * self.MAX_RATE:
+                        self._global_rate = None
+            else:
+                pace.rate = max(pace.rate * self.BACKOFF[signal], self.MIN_RATE)
+                if signal == THROTTLED:
+                    window = max(time.time() - self._recent[0], 1.0) if self._recent else self.WINDOW
+                    recent_rate = len(self._recent) / window
+                    if self._global_rate is not None:
+                        recent_rate = min(recent_rate, self._global_rate)
+                    self._global_rate = max(recent_rate * self.BACKOFF[THROTTLED], self.MIN_RATE)
+
+    def next_call(self, username):
+        """Time at which the account may send its next request."""
+        with self._lock:
+            return time.time() + 1 / self._pace(username).rate
+
+    def stats(self):
+        with self._lock:
+            accounts = dict((username, {'requests-per-hour': round(pace.rate * 3600, 1),
+                                        'requests': pace.requests,
+                                        'signals': dict(pace.signals)})
+                            for username, pace in self._accounts.iteritems())
+            global_rate = self._global_rate
+            return {'global-requests-per-hour': round(global_rate * 3600, 1) if global_rate else None,
+                    'requests-per-hour': round(sum(pace.rate for pace in self._accounts.itervalues()) * 3600, 1),
+                    'accounts': accounts}
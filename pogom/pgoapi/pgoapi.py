@@ -30,15 +30,17 @@ import six
 import logging
 import requests
 import time
-import math
 from threading import Thread
-from Queue import Queue, PriorityQueue
 
 from . import __title__, __version__, __copyright__
 from .rpc_api import RpcApi
+from .work_queue import WorkQueue
+from .account_scheduler import AccountScheduler
+from .auth_maintainer import AuthMaintainer
+from .pacing import PacingController, HEALTHY, EMPTY, CODE_THREE, THROTTLED
 from .auth_ptc import AuthPtc
 from .auth_google import AuthGoogle
-from .exceptions import AuthException, NotLoggedInException, ServerBusyOrOfflineException, NoPlayerPositionSetException, EmptySubrequestChainException, ServerApiEndpointRedirectException, AuthTokenExpiredException
+from .exceptions import AuthException, NotLoggedInException, ServerBusyOrOfflineException, NoPlayerPositionSetException, EmptySubrequestChainException, ServerApiEndpointRedirectException, AuthTokenExpiredException, ServerSideRequestThrottlingException
 
 from . import protos
 from POGOProtos.Networking.Requests.RequestType_pb2 import RequestType
@@ -47,12 +49,17 @@ logger = logging.getLogger(__name__)
 
 
 class PGoApi:
-    def __init__(self, signature_lib_path):
+    def __init__(self, signature_lib_path, token_cache=None, login_threads=4):
         self.set_logger()
 
         self._signature_lib_path = signature_lib_path
-        self._work_queue = Queue()
-        self._auth_queue = PriorityQueue()
+        self._work_queue = WorkQueue()
+        self._accounts = AccountScheduler()
+        self._pacing = PacingController()
+        self._auth = AuthMaintainer(self._accounts, self._pacing, num_threads=login_threads)
+        self._token_cache = token_cache
+        if token_cache is not None:
+            token_cache.start()
         self._workers = []
         self._api_endpoint = 'https://pgorelease.nianticlabs.com/plfe/rpc'
 
@@ -60,7 +67,7 @@ class PGoApi:
 
     def create_workers(self, num_workers):
         for i in xrange(num_workers):
-            worker = PGoApiWorker(self._signature_lib_path, self._work_queue, self._auth_queue)
+            worker = PGoApiWorker(self._signature_lib_path, self._work_queue, self._accounts, self._pacing, self._auth)
             worker.daemon = True
             worker.start()
             self._workers.append(worker)
@@ -75,28 +82,15 @@ class PGoApi:
                 worker.stop()
 
     def set_accounts(self, accounts):
-        old_accounts = []
-        new_accounts = []
-
-        accounts_todo = {}
-        for account in accounts:
-            accounts_todo[account['username']] = accounts['password']
-
-        while not self._auth_queue.empty():
-            # Go through accounts in auth queue and only add those back
-            # that we still want to use
-            next_call, auth_provider = self._auth_queue.get()
-            if auth_provider.username in accounts_todo:
-                old_accounts.append((next_call, auth_provider))
-                del accounts_todo[auth_provider.username]
-
-        while old_accounts:
-            self._auth_queue.put(old_accounts.pop())
-
-        # Add new accounts
-        for username, password in accounts_todo.iteritems():
-            new_accounts.append({'username': username, 'password': password})
-        add_accounts(new_accounts)
+        """Adds new accounts and removes those that are not in accounts anymore.
+        Accounts in use are removed once their worker is done with them."""
+        usernames = set(account['username'] for account in accounts)
+        for username in self._accounts.usernames() - usernames:
+            self._accounts.remove(username)
+            self._pacing.remove(username)
+            if self._token_cache is not None:
+                self._token_cache.untrack(username)
+        self.add_accounts(accounts)
 
     def add_accounts(self, accounts):
         for account in accounts:
@@ -104,6 +98,9 @@ class PGoApi:
             if not isinstance(username, six.string_types) or not isinstance(password, six.string_types):
                 raise AuthException("Username/password not correctly specified")
 
+            if username in self._accounts:
+                continue
+
             provider = account.get('provider', 'ptc')
             if provider == 'ptc':
                 auth_provider = AuthPtc(username, password)
@@ -112,7 +109,17 @@ class PGoApi:
             else:
                 raise AuthException("Invalid authentication provider - only ptc/google available.")
 
-            self._auth_queue.put((time.time(), auth_provider))
+            restored = False
+            if self._token_cache is not None:
+                self._token_cache.track(auth_provider)
+                restored = self._token_cache.restore(auth_provider)
+
+            if restored and not self._auth.needs_login(auth_provider, time.time()):
+                self._accounts.add(auth_provider)
+            else:
+                # Handed to the workers once it's logged in
+                self._accounts.add(auth_provider, held=True)
+                self._auth.login(auth_provider)
 
     def set_logger(self, logger=None):
         self.log = logger or logging.getLogger(__name__)
@@ -126,6 +133,9 @@ class PGoApi:
 
             position = kwargs.pop('position')
             callback = kwargs.pop('callback')
+            key = kwargs.pop('key', position)
+            deadline = kwargs.pop('deadline', None)
+            token = kwargs.pop('token', None)
 
             if kwargs:
                 method = {RequestType.Value(name): kwargs}
@@ -136,43 +146,59 @@ class PGoApi:
                 method = RequestType.Value(name)
                 self.log.debug("Adding '%s' to RPC request", name)
 
-            self.call_method(method, position, callback)
+            self.call_method(method, position, callback, key, deadline, token)
 
         if func.upper() in RequestType.keys():
             return function
         else:
             raise AttributeError
 
-    def call_method(self, method, position, callback):
-        self._work_queue.put((method, position, callback))
+    def call_method(self, method, position, callback, key=None, deadline=None, token=None):
+        # Calls whose token is cancelled are dropped by the workers
+        self._work_queue.put((method, position, callback, token),
+                             key if key is not None else position, deadline)
+
+    def reprioritize(self, key, deadline=None):
+        self._work_queue.reprioritize(key, deadline)
 
     def empty_work_queue(self):
-        while not self._work_queue.empty():
-            try:
-                self._work_queue.get(False)
-                self._work_queue.task_done()
-            except Queue.Empty:
-                return
+        self._work_queue.clear()
 
     def is_work_queue_empty(self):
         return self._work_queue.empty()
 
-    def wait_until_done(self):
-        self._work_queue.join()
+    def get_work_queue_stats(self):
+        return self._work_queue.stats()
+
+    def get_pacing_stats(self):
+        return self._pacing.stats()
+
+    def get_login_stats(self):
+        return dict(self._auth.stats(), ready=self._accounts.num_ready())
+
+    def get_num_workers(self):
+        return len(self._workers)
+
+    def wait_for_queue_space(self, max_size, timeout=None):
+        return self._work_queue.wait_for_space(max_size, timeout)
+
+    def wait_until_done(self, timeout=None):
+        return self._work_queue.join(timeout)
 
 
 class PGoApiWorker(Thread):
-    THROTTLE_TIME = 10.0
     # In case the server returns a status code 3, this has to be requested
     SC_3_REQUESTS = [RequestType.Value("GET_PLAYER")]
 
-    def __init__(self, signature_lib_path, work_queue, auth_queue):
+    def __init__(self, signature_lib_path, work_queue, accounts, pacing, auth):
         Thread.__init__(self)
         self.log = logging.getLogger(__name__)
         self._running = True
 
         self._work_queue = work_queue
-        self._auth_queue = auth_queue
+        self._accounts = accounts
+        self._pacing = pacing
+        self._auth = auth
 
         self._session = requests.session()
         self._session.headers.update({'User-Agent': 'Niantic App'})
@@ -182,54 +208,66 @@ class PGoApiWorker(Thread):
         self.rpc_api._session = self._session
         self.rpc_api.activate_signature(signature_lib_path)
 
-    def _get_auth_provider(self):
-        while True:  # Maybe change this loop to something more beautiful?
-            next_call, auth_provider = self._auth_queue.get()
-            if (time.time() + self.THROTTLE_TIME < next_call):
-                # Probably one of the sidelined auth providers, skip it
-                self._auth_queue.put((next_call, auth_provider))
-            else:
-                # Sleep until the auth provider is ready
-                if (time.time() < next_call):  # Kind of a side effect -> bad
-                    time.sleep(max(next_call - time.time(), 0))
-                return (next_call, auth_provider)
-
     def run(self):
         while self._running:
-            method, position, callback = self._work_queue.get()
+            key, deadline, item = self._work_queue.get()
+            method, position, callback, token = item
+            if token is not None and token.cancelled:
+                self._work_queue.task_done()
+                continue
             if not self._running:
-                self._work_queue.put((method, position, callback))
+                self._work_queue.put(item, key, deadline)
                 self._work_queue.task_done()
                 continue
 
-            next_call, auth_provider = self._get_auth_provider()
+            # Waits for a slot if the server throttled this IP, before an
+            # account is taken so none is held during the back-off
+            wait = self._pacing.reserve()
+            if wait > 0:
+                time.sleep(wait)
+                if token is not None and token.cancelled:
+                    self._work_queue.task_done()
+                    continue
+
+            # Blocks until the account that is ready first can be used
+            auth_provider = self._accounts.acquire()
             if not self._running:
-                self._auth_queue.put((next_call, auth_provider))
-                self._work_queue.put((method, position, callback))
+                self._accounts.release(auth_provider, time.time())
+                self._work_queue.put(item, key, deadline)
                 self._work_queue.task_done()
                 continue
 
             # Let's do this.
             self.rpc_api._auth_provider = auth_provider
+            logged_out = False
             try:
                 response = self.call(auth_provider, [method], position)
-                next_call = time.time() + self.THROTTLE_TIME
+                if response:
+                    self._pacing.report(auth_provider.username, HEALTHY)
+                    self._work_queue.succeeded(key)
             except Exception as e:
-                # Too many login retries lead to an AuthException
-                # So let us sideline this auth provider for 5 minutes
-                if isinstance(e, AuthException):
-                    self.log.error("AuthException in worker thread. Username: {}".format(auth_provider.username))
-                    next_call = time.time() + 5 * 60
+                if isinstance(e, (NotLoggedInException, AuthTokenExpiredException)):
+                    self.log.info("{} has to log in again.".format(auth_provider.username))
+                    logged_out = True
+                elif isinstance(e, ServerSideRequestThrottlingException):
+                    self.log.info("Request throttled. Username: {}".format(auth_provider.username))
+                    self._pacing.report(auth_provider.username, THROTTLED)
                 else:
                     self.log.error("Error in worker thread. Returning empty response. Error: {}".format(e))
-                    next_call = time.time() + self.THROTTLE_TIME
 
-                self._work_queue.put((method, position, callback))
+                # Back into the queue, still ordered by its last successful scan
+                if token is None or not token.cancelled:
+                    self._work_queue.put(item, key, deadline)
                 response = {}
 
             self._work_queue.task_done()
             self.rpc_api._auth_provider = None
-            self._auth_queue.put((next_call, auth_provider))
+            next_call = self._pacing.next_call(auth_provider.username)
+            if logged_out or self._auth.needs_login(auth_provider, next_call):
+                self._accounts.hold(auth_provider)
+                self._auth.login(auth_provider, next_call)
+            else:
+                self._accounts.release(auth_provider, next_call)
             callback(response)
 
     def stop(self):
@@ -249,16 +287,16 @@ class PGoApiWorker(Thread):
         again = True  # Status code 53 or not logged in?
         retries = 5
         while again:
-            self._login_if_necessary(auth_provider, position)
-
             try:
                 response = self.rpc_api.request(auth_provider.get_api_endpoint(), req_method_list, position)
                 if not response:
                     raise ValueError('Request returned problematic response: {}'.format(response))
             except (NotLoggedInException, AuthTokenExpiredException):
-                pass  # Trying again will trigger login in _login_if_necessary
+                raise  # the auth maintainer logs the account in again
             except ServerApiEndpointRedirectException as e:
                 auth_provider.set_api_endpoint('https://{}/rpc'.format(e.get_redirected_endpoint()))
+            except ServerSideRequestThrottlingException:
+                raise  # retrying right away only makes it worse
             except Exception as e:  # Never crash the worker
                 if isinstance(e, ServerBusyOrOfflineException):
                     self.log.info('Server seems to be busy or offline: {}'.format(e))
@@ -275,10 +313,13 @@ class PGoApiWorker(Thread):
                     self.log.info("Status code 3 returned. Performing get_player request.")
                     req_method_list = self.SC_3_REQUESTS + req_method_list
                     auth_provider.code_three_counter += 1
+                    self._pacing.report(auth_provider.username, CODE_THREE)
                 elif 'responses' in response and not response['responses']:
-                    self.log.info("Received empty map_object response. Logging out and retrying.")
-                    auth_provider._access_token_expiry = time.time() # This will trigger a login in _login_if_necessary
+                    self.log.info("Received empty map_object response. Logging out.")
+                    auth_provider._access_token_expiry = time.time()
                     auth_provider.code_three_counter = 0
+                    self._pacing.report(auth_provider.username, EMPTY)
+                    raise NotLoggedInException()
                 else:
                     again = False
                     auth_provider.code_three_counter = 0
@@ -287,23 +328,3 @@ class PGoApiWorker(Thread):
                     self.log.info("Received two consecutive status_code 3 on account {}, probably banned.".format(auth_provider.username))
 
         return response
-
-    def _login(self, auth_provider, position):
-        self.log.info('Attempting login: {}'.format(auth_provider.username))
-        consecutive_fails = 0
-
-        while not auth_provider.user_login():
-            sleep_t = min(math.exp(consecutive_fails / 1.7), 5 * 60)
-            self.log.info('Login failed, retrying in {:.2f} seconds'.format(sleep_t))
-            consecutive_fails += 1
-            time.sleep(sleep_t)
-            if consecutive_fails == 5:
-                raise AuthException('Login failed five times.')
-
-        self.log.info('Login successful: {}'.format(auth_provider.username))
-
-    def _login_if_necessary(self, auth_provider, position):
-        if not auth_provider.is_login() or auth_provider._access_token_expiry < time.time() + 120:
-            if auth_provider.is_login():
-                self.log.info("{} access token has or is about to expire".format(auth_provider.username))
-            self._login(auth_provider, position)
@@ -42,25 +42,66 @@ def enum_label_name(field, value):
 
 
 def protobuf_to_dict(pb, type_callable_map=TYPE_CALLABLE_MAP, use_enum_labels=False):
-    result_dict = {}
-    extensions = {}
-    for field, value in pb.ListFields():
+    return _get_converter(pb.DESCRIPTOR, type_callable_map, use_enum_labels)(pb)
+
+
+# (descriptor, id(type_callable_map), use_enum_labels) -> (converter, type_callable_map)
+# The map is kept referenced so its id can't be reused.
+_converters = {}
+
+
+def _get_converter(descriptor, type_callable_map, use_enum_labels):
+    key = (descriptor, id(type_callable_map), use_enum_labels)
+    try:
+        return _converters[key][0]
+    except KeyError:
+        return _compile_converter(key, descriptor, type_callable_map, use_enum_labels)
+
+
+def _compile_converter(key, descriptor, type_callable_map, use_enum_labels):
+    """Builds the conversion function of one message type.
+
+    Each field's conversion is resolved once and looked up by its descriptor
+    afterwards. The converter is registered before its fields are compiled,
+    so recursive message types resolve to it.
+    """
+    handlers = {}
+
+    def make_handler(pb, field):
         if field.message_type and field.message_type.has_options and field.message_type.GetOptions().map_entry:
-            result_dict[field.name] = dict(value)
-            continue
-        type_callable = _get_field_value_adaptor(pb, field, type_callable_map, use_enum_labels)
+            return field.name, dict, False
+
+        if field.type == FieldDescriptor.TYPE_MESSAGE:
+            type_callable = _get_converter(field.message_type, type_callable_map, use_enum_labels)
+        else:
+            type_callable = _get_field_value_adaptor(pb, field, type_callable_map, use_enum_labels)
         if field.label == FieldDescriptor.LABEL_REPEATED:
             type_callable = repeated(type_callable)
 
         if field.is_extension:
-            extensions[str(field.number)] = type_callable(value)
-            continue
-
-        result_dict[field.name] = type_callable(value)
-
-    if extensions:
-        result_dict[EXTENSION_CONTAINER] = extensions
-    return result_dict
+            return str(field.number), type_callable, True
+        return field.name, type_callable, False
+
+    def converter(pb):
+        result_dict = {}
+        extensions = {}
+        for field, value in pb.ListFields():
+            try:
+                name, type_callable, is_extension = handlers[field]
+            except KeyError:
+                name, type_callable, is_extension = handlers[field] = make_handler(pb, field)
+
+            if is_extension:
+                extensions[name] = type_callable(value)
+            else:
+                result_dict[name] = type_callable(value)
+
+        if extensions:
+            result_dict[EXTENSION_CONTAINER] = extensions
+        return result_dict
+
+    _converters[key] = (converter, type_callable_map)
+    return converter
 
 
 def _get_field_value_adaptor(pb, field, type_callable_map=TYPE_CALLABLE_MAP, use_enum_labels=False):
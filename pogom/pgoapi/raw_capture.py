@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Capture of raw RPC responses for replaying and benchmarking."""
+
+import os
+import time
+import struct
+import logging
+from threading import Thread
+from Queue import Queue, Full
+
+# Record layout: timestamp, number of request types, request types,
+# length of the response envelope, response envelope
+RECORD_HEADER = struct.Struct('<dH')
+REQUEST_TYPE = struct.Struct('<H')
+CONTENT_LENGTH = struct.Struct('<I')
+
+
+class RawCapture(Thread):
+    """Writes raw RPC responses to rotating capture files.
+
+    The RPC workers only hand the response bytes to put(), which never
+    blocks: records are dropped when the writer falls behind. Files are
+    rotated like logging's RotatingFileHandler (capture.bin, capture.bin.1,
+    ...). Use read_capture() to iterate over a capture file.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, backup_count=5, max_pending=1000):
+        Thread.__init__(self)
+        self.daemon = True
+        self.name = 'raw_capture'
+        self.log = logging.getLogger(__name__)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        self.dropped = 0
+        self._queue = Queue(max_pending)
+        self._file = None
+
+    def put(self, subrequests, content):
+        try:
+            self._queue.put_nowait((time.time(), subrequests, content))
+        except Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            timestamp, subrequests, content = self._queue.get()
+            try:
+                self._write(self._encode(timestamp, subrequests, content))
+            except Exception as e:
+                self.log.error('Could not write raw capture: {}'.format(e))
+
+    @staticmethod
+    def _encode(timestamp, subrequests, content):
+        request_types = [entry if isinstance(entry, int) else list(entry.keys())[0]
+                         for entry in subrequests]
+        return b''.join([RECORD_HEADER.pack(timestamp, len(request_types))] +
+                        [REQUEST_TYPE.pack(t) for t in request_types] +
+                        [CONTENT_LENGTH.pack(len(content)), content])
+
+    def _write(self, record):
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._file = open(self.path, 'ab')
+
+        if self._file.tell() + len(record) > self.max_bytes and self._file.tell() > 0:
+            self._rotate()
+
+        self._file.write(record)
+        self._file.flush()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = '{}.{}'.format(self.path, i)
+            dst = '{}.{}'.format(self.path, i + 1)
+            if os.path.exists(src):
+                if os.path.exists(dst):
+                    os.remove(dst)
+                os.rename(src, dst)
+        if self.backup_count > 0:
+            dst = self.path + '.1'
+            if os.path.exists(dst):
+                os.remove(dst)
+            os.rename(self.path, dst)
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'ab')
+
+
+def read_capture(path):
+    """Yields (timestamp, request_types, response_envelope) of a capture file."""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, num_types = RECORD_HEADER.unpack(header)
+            request_types = [REQUEST_TYPE.unpack(f.read(REQUEST_TYPE.size))[0] for _ in range(num_types)]
+            length, = CONTENT_LENGTH.unpack(f.read(CONTENT_LENGTH.size))
+            content = f.read(length)
+            if len(content) < length:
+                return  # truncated record
+            yield timestamp, request_types, content
@@ -58,6 +58,11 @@ class RpcApi:
 
     RPC_ID = 0
     START_TIME = 0
+    # Optional RawCapture that receives every raw response envelope
+    RAW_CAPTURE = None
+    # Sub responses returned as parsed messages instead of dicts, unless
+    # debug logging is enabled
+    MESSAGE_RESPONSES = set(['GET_MAP_OBJECTS'])
 
     def __init__(self, auth_provider, device_info=None):
 
@@ -327,17 +332,19 @@ class RpcApi:
             return False
 
         self.log.debug('Protobuf structure of rpc response:\n\r%s', response_proto)
-        try:
-            self.log.debug('Decode raw over protoc (protoc has to be in your PATH):\n\r%s', self.decode_raw(response_raw.content).decode('utf-8'))
-        except:
-            self.log.debug('Error during protoc parsing - ignored.')
+        if RpcApi.RAW_CAPTURE is not None:
+            RpcApi.RAW_CAPTURE.put(subrequests, response_raw.content)
+
+        # The sub responses are parsed separately, don't base64 encode them
+        returns = list(response_proto.returns)
+        response_proto.ClearField('returns')
 
         response_proto_dict = protobuf_to_dict(response_proto)
-        response_proto_dict = self._parse_sub_responses(response_proto, subrequests, response_proto_dict)
+        response_proto_dict = self._parse_sub_responses(returns, subrequests, response_proto_dict)
 
         return response_proto_dict
 
-    def _parse_sub_responses(self, response_proto, subrequests_list, response_proto_dict):
+    def _parse_sub_responses(self, returns, subrequests_list, response_proto_dict):
         self.log.debug('Parsing sub RPC responses...')
         response_proto_dict['responses'] = {}
 
@@ -351,7 +358,8 @@ class RpcApi:
 
         list_len = len(subrequests_list)-1
         i = 0
-        for subresponse in response_proto.returns:
+        convert_all = self.log.isEnabledFor(logging.DEBUG)
+        for subresponse in returns:
             if i > list_len:
                 self.log.info("Error - something strange happend...")
 
@@ -379,7 +387,10 @@ class RpcApi:
             if subresponse_extension:
                 try:
                     subresponse_extension.ParseFromString(subresponse)
-                    subresponse_return = protobuf_to_dict(subresponse_extension)
+                    if entry_name in self.MESSAGE_RESPONSES and not convert_all:
+                        subresponse_return = subresponse_extension
+                    else:
+                        subresponse_return = protobuf_to_dict(subresponse_extension)
                 except:
                     error = "Protobuf definition for {} seems not to match".format(proto_classname)
                     subresponse_return = error
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Persistent cache of login tokens across restarts."""
+
+import os
+import glob
+import json
+import time
+import base64
+import logging
+from threading import Thread, Lock
+
+from Cryptodome.Cipher import AES
+from Cryptodome.Protocol.KDF import PBKDF2
+from Cryptodome.Random import get_random_bytes
+
+# File layout: magic, salt of the key derivation, GCM nonce, GCM tag, ciphertext
+MAGIC = b'PGTC1'
+SALT_SIZE = 16
+NONCE_SIZE = 16
+TAG_SIZE = 16
+
+
+def _cache_key(auth_provider):
+    return '{}:{}'.format(auth_provider.get_name(), auth_provider.username)
+
+
+class TokenCache(Thread):
+    """Keeps the access tokens, session tickets and api endpoints of the
+    accounts in an encrypted file, so accounts with a valid token can be
+    used right after a restart instead of logging in again.
+
+    The file is encrypted with AES-GCM, the key is derived from the `key`
+    passphrase. Tracked accounts are written every SAVE_INTERVAL seconds if
+    anything changed. Every scan process writes its own file (`name`), the
+    files of all of them are read on startup.
+    """
+
+    SAVE_INTERVAL = 30.0
+
+    def __init__(self, cache_path, key, name='tokens-0'):
+        Thread.__init__(self)
+        self.daemon = True
+        self.name = 'token_cache'
+        self.log = logging.getLogger(__name__)
+
+        self.cache_path = cache_path
+        self.path = os.path.join(cache_path, name + '.bin')
+        self._key = key
+        self._salt = get_random_bytes(SALT_SIZE)
+        self._aes_key = self._derive_key(self._salt)
+
+        self._lock = Lock()
+        self._tracked = {}  # username -> auth_provider
+        self._saved = None
+        self._entries = self._load_all()
+
+    def _derive_key(self, salt):
+        return PBKDF2(self._key, salt, dkLen=32, count=10000)
+
+    def _load_all(self):
+        entries = {}
+        for path in glob.glob(os.path.join(self.cache_path, 'tokens-*.bin')):
+            for key, entry in self._load(path).iteritems():
+                # Accounts can move between processes, keep the newest token
+                if key not in entries or entry['access_token_expiry'] > entries[key]['access_token_expiry']:
+                    entries[key] = entry
+        if entries:
+            self.log.info('Loaded {} cached access tokens'.format(len(entries)))
+        return entries
+
+    def _load(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            if not data.startswith(MAGIC):
+                raise ValueError('Not a token cache')
+
+            data = data[len(MAGIC):]
+            salt, nonce, tag = (data[:SALT_SIZE], data[SALT_SIZE:SALT_SIZE + NONCE_SIZE],
+                                data[SALT_SIZE + NONCE_SIZE:SALT_SIZE + NONCE_SIZE + TAG_SIZE])
+            cipher = AES.new(self._derive_key(salt), AES.MODE_GCM, nonce=nonce)
+            return json.loads(cipher.decrypt_and_verify(data[SALT_SIZE + NONCE_SIZE + TAG_SIZE:], tag))
+        except (IOError, OSError, ValueError, KeyError) as e:
+            # Also raised if the key changed
+            self.log.warning('Could not load token cache {}: {}'.format(path, e))
+            return {}
+
+    def track(self, auth_provider):
+        with self._lock:
+            self._tracked[auth_provider.username] = auth_provider
+
+    def untrack(self, username):
+        with self._lock:
+            self._tracked.pop(username, None)
+
+    def restore(self, auth_provider):
+        """Restores the cached token of the account, returns True if it's
+        still valid."""
+        entry = self._entries.pop(_cache_key(auth_provider), None)
+        if entry is None or entry['access_token_expiry'] < time.time() + 120:
+            return False
+
+        auth_provider._access_token = entry['access_token']
+        auth_provider._access_token_expiry = entry['access_token_expiry']
+        auth_provider._login = True
+        auth_provider.set_api_endpoint(entry['api_endpoint'])
+        if entry['ticket_expire'] and entry['ticket_expire'] > time.time() * 1000:
+            auth_provider.set_ticket([entry['ticket_expire'],
+                                      base64.b64decode(entry['ticket_start']),
+                                      base64.b64decode(entry['ticket_end'])])
+        return auth_provider.is_login()
+
+    def run(self):
+        while True:
+            time.sleep(self.SAVE_INTERVAL)
+            try:
+                self.save()
+            except Exception as e:  # never let the thread die
+                self.log.error('Could not save token cache: {}'.format(e))
+
+    def save(self):
+        with self._lock:
+            auth_providers = self._tracked.values()
+
+        entries = {}
+        for auth_provider in auth_providers:
+            if not auth_provider.is_login() or not auth_provider._access_token_expiry:
+                continue
+            has_ticket = auth_provider.has_ticket()
+            entries[_cache_key(auth_provider)] = {
+                'access_token': auth_provider._access_token,
+                'access_token_expiry': auth_provider._access_token_expiry,
+                'api_endpoint': auth_provider.get_api_endpoint(),
+                'ticket_expire': auth_provider._ticket_expire if has_ticket else None,
+                'ticket_start': base64.b64encode(auth_provider._ticket_start) if has_ticket else None,
+                'ticket_end': base64.b64encode(auth_provider._ticket_end) if has_ticket else None}
+
+        data = json.dumps(entries, sort_keys=True)
+        if data == self._saved:
+            return
+
+        cipher = AES.new(self._aes_key, AES.MODE_GCM, nonce=get_random_bytes(NONCE_SIZE))
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+
+        if not os.path.isdir(self.cache_path):
+            os.makedirs(self.cache_path)
+        tmp_path = self.path + '.tmp'
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb') as f:
+            f.write(MAGIC + self._salt + cipher.nonce + tag + ciphertext)
+        if os.path.isfile(self.path):
+            os.remove(self.path)  # rename does not overwrite on Windows
+        os.rename(tmp_path, self.path)
+        self._saved = data
+        self.log.debug('Saved {} access tokens'.format(len(entries)))
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Deadline ordered queue of the RPC calls waiting for an account."""
+
+import heapq
+import time
+from itertools import count
+from threading import Condition
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+class WorkQueue(object):
+    """Priority queue of RPC calls ordered by deadline and staleness.
+
+    Every call has a key, the scan position by default. Calls with a
+    deadline are served by deadline, the others by the time their key was
+    last completed successfully, so the stalest steps go first. Putting a
+    key that is already queued replaces the queued call, which also allows
+    reprioritising without draining the queue.
+
+    Implements the parts of Queue's interface used by the workers (get,
+    put, task_done, join, empty, qsize).
+    """
+
+    def __init__(self):
+        self._cond = Condition()
+        self._heap = []
+        self._entries = {}  # key -> [priority, seq, key, deadline, queued_at, item]
+        self._last_success = {}
+        self._seq = count()
+        self._unfinished = 0
+        self._epoch = 0  # incremented by clear(), wakes up join()
+
+    def _push(self, key, item, deadline, queued_at):
+        old = self._entries.get(key)
+        if old is not None:
+            old[-1] = None  # invalidated, skipped by get()
+        else:
+            self._unfinished += 1
+
+        priority = deadline if deadline is not None else self._last_success.get(key, 0.0)
+        entry = [priority, next(self._seq), key, deadline, queued_at, item]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        self._cond.notify_all()  # producers wait on the same condition
+
+    def put(self, item, key, deadline=None):
+        with self._cond:
+            old = self._entries.get(key)
+            self._push(key, item, deadline, old[4] if old is not None else time.time())
+
+    def reprioritize(self, key, deadline=None):
+        """Moves a queued call to its new deadline (None: by staleness)."""
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._push(key, entry[-1], deadline, entry[4])
+
+    def get(self):
+        """Returns (key, deadline, item) of the most urgent call, blocks while empty."""
+        with self._cond:
+            while True:
+                while not self._entries:
+                    self._cond.wait()
+                priority, seq, key, deadline, queued_at, item = heapq.heappop(self._heap)
+                if item is not None:
+                    del self._entries[key]
+                    self._cond.notify_all()
+                    return key, deadline, item
+
+    def task_done(self):
+        with self._cond:
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._unfinished = 0
+                self._cond.notify_all()
+
+    def succeeded(self, key):
+        with self._cond:
+            self._last_success[key] = time.time()
+
+    def clear(self):
+        with self._cond:
+            self._unfinished -= len(self._entries)
+            self._entries = {}
+            self._heap = []
+            if self._unfinished <= 0:
+                self._unfinished = 0
+            self._epoch += 1
+            self._cond.notify_all()
+
+    def wait_for_space(self, max_size, timeout=None):
+        """Waits until fewer than max_size calls are queued. Returns False if
+        timeout seconds passed first."""
+        end = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while len(self._entries) >= max_size:
+                if end is None:
+                    self._cond.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            return True
+
+    def join(self, timeout=None):
+        """Waits until all calls are done or the queue is cleared. Returns
+        False if timeout seconds passed first."""
+        end = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            epoch = self._epoch
+            while self._unfinished and self._epoch == epoch:
+                if end is None:
+                    self._cond.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            return True
+
+    def empty(self):
+        return not self._entries
+
+    def qsize(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Queue depth and percentiles of the seconds calls have been waiting
+        and of the seconds since their key was last scanned successfully."""
+        now = time.time()
+        with self._cond:
+            entries = self._entries.values()
+            ages = sorted(now - e[4] for e in entries)
+            staleness = sorted(now - self._last_success[e[2]] for e in entries if e[2] in self._last_success)
+
+        return {'depth': len(ages),
+                'age_p50': percentile(ages, 50),
+                'age_p90': percentile(ages, 90),
+                'age_max': ages[-1] if ages else 0.0,
+                'staleness_p50': percentile(staleness, 50),
+                'staleness_p90': percentile(staleness, 90),
+                'staleness_max': staleness[-1] if staleness else 0.0}
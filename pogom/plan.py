@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import time
+import tempfile
+
+import numpy as np
+
+from pgoapi.utilities import get_cell_ids
+
+log = logging.getLogger(__name__)
+
+
+class ScanPlan(object):
+    """Compiled scan steps of a cover.
+
+    Holds the coordinates of every step, their f2i encoded values and the
+    sorted S2 cell ids to request, so a scan cycle never has to run the
+    S2 region coverer. Cell ids of step i are
+    cell_ids[offsets[i]:offsets[i + 1]].
+    """
+    VERSION = 1
+    CELL_RADIUS = 70
+
+    def __init__(self, key, lats, lngs, offsets, cell_ids):
+        self.key = key
+        self.lats = lats
+        self.lngs = lngs
+        # f2i() is the bit pattern of the double
+        self.lats_i = lats.view('<u8')
+        self.lngs_i = lngs.view('<u8')
+        self.offsets = offsets
+        self.cell_ids = cell_ids
+
+    def __len__(self):
+        return len(self.lats)
+
+    def step(self, i):
+        return (float(self.lats[i]), float(self.lngs[i]),
+                long(self.lats_i[i]), long(self.lngs_i[i]),
+                self.cell_ids[self.offsets[i]:self.offsets[i + 1]].tolist())
+
+    def steps(self):
+        for i in xrange(len(self)):
+            yield self.step(i)
+
+    @classmethod
+    def compile(cls, key, cover):
+        start = time.time()
+        lats = np.array([p['lat'] for p in cover], dtype='<f8')
+        lngs = np.array([p['lng'] for p in cover], dtype='<f8')
+
+        offsets = np.zeros(len(cover) + 1, dtype=np.int32)
+        cell_ids = []
+        for i, (lat, lng) in enumerate(zip(lats.tolist(), lngs.tolist())):
+            cell_ids.extend(get_cell_ids(lat, lng, radius=cls.CELL_RADIUS))
+            offsets[i + 1] = len(cell_ids)
+
+        plan = cls(key, lats, lngs, offsets, np.array(cell_ids, dtype=np.uint64))
+        log.info('Compiled scan plan with {} steps and {} cells in {:.2f}s'.format(
+            len(plan), len(cell_ids), time.time() - start))
+        return plan
+
+    @classmethod
+    def _path(cls, cache_path, key):
+        return os.path.join(cache_path, 'plan-v{}-{}.npz'.format(cls.VERSION, key))
+
+    @classmethod
+    def load(cls, cache_path, key):
+        path = cls._path(cache_path, key)
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            with np.load(path) as data:
+                plan = cls(key, data['lats'], data['lngs'], data['offsets'], data['cell_ids'])
+        except Exception as e:
+            log.warning('Could not load scan plan {}: {}'.format(path, e))
+            return None
+
+        log.info('Loaded scan plan with {} steps from {}'.format(len(plan), path))
+        return plan
+
+    def save(self, cache_path):
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+
+        # Unique name, the scan processes may save the same plan at once
+        path = self._path(cache_path, self.key)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=cache_path)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, lats=self.lats, lngs=self.lngs,
+                     offsets=self.offsets, cell_ids=self.cell_ids)
+        try:
+            if os.name == 'nt' and os.path.isfile(path):
+                os.remove(path)  # rename does not overwrite on Windows
+            os.rename(tmp_path, path)
+        except OSError:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def get(cls, key, cover, cache_path=None):
+        if cache_path:
+            plan = cls.load(cache_path, key)
+            if plan is not None and len(plan) == len(cover):
+                return plan
+
+        plan = cls.compile(key, cover)
+        if cache_path:
+            try:
+                plan.save(cache_path)
+            except (IOError, OSError) as e:
+                log.warning('Could not save scan plan: {}'.format(e))
+        return plan
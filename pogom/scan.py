@@ -9,16 +9,20 @@ import cProfile
 import os
 import json
 import random
+import hashlib
 from datetime import datetime
 from itertools import izip, count
-from threading import Thread
+from functools import partial
+from threading import Thread, Lock, Condition
 
 from pgoapi import PGoApi
-from pgoapi.utilities import f2i, get_cell_ids, get_pos_by_name
-from sys import maxint
-from geographiclib.geodesic import Geodesic
+from pgoapi.token_cache import TokenCache
+from pgoapi.utilities import get_pos_by_name
 
-from .models import parse_map
+from .cover import build_cover, build_spawnpoint_cover
+from .models import parse_map, parse_map_cells, CellTimestamp
+from .plan import ScanPlan
+from .spawns import SpawnSchedule, learn_spawnpoints
 from . import config
 
 log = logging.getLogger(__name__)
@@ -34,39 +38,95 @@ class ScanMetrics:
     NUM_THREADS = 0
     NUM_ACCOUNTS = 0
     CURRENT_SCAN_PERCENT = 0.0
+    WORK_QUEUE = {}
+    PACING = {}
+    LOGINS = {}
 
 
-class Scanner(Thread):
+class CancelToken(object):
+    """Cancelled as soon as the scan configuration changes after its creation."""
+
     def __init__(self, scan_config):
+        self.scan_config = scan_config
+        self.generation = scan_config.GENERATION
+
+    @property
+    def cancelled(self):
+        return self.generation != self.scan_config.GENERATION
+
+    def wait(self, timeout=None):
+        """Sleeps until cancelled or timeout seconds passed. Returns True if cancelled."""
+        return self.scan_config.wait_for_change(self.generation, timeout)
+
+
+class Scanner(Thread):
+    EXPLORE_EVERY = 10
+    QUEUED_STEPS_PER_WORKER = 2
+    API_METRICS_INTERVAL = 2.0
+
+    def __init__(self, scan_config, ingest, shard=(0, 1)):
         Thread.__init__(self)
         self.daemon = True
         self.name = 'search_thread'
 
-        self.api = PGoApi(config['SIGNATURE_LIB_PATH'])
-        self.scan_config = scan_config
+        token_cache = None
+        if config.get('TOKEN_CACHE_KEY', None) and config['CACHE_PATH']:
+            token_cache = TokenCache(config['CACHE_PATH'], config['TOKEN_CACHE_KEY'],
+                                     name='tokens-{}'.format(shard[0]))
 
-    def next_position(self):
-        for point in self.scan_config.COVER:
-            yield (point["lat"], point["lng"], 0)
+        self.api = PGoApi(config['SIGNATURE_LIB_PATH'], token_cache=token_cache,
+                          login_threads=config['LOGIN_THREADS'])
+        self.scan_config = scan_config
+        self.ingest = ingest
+        # (index, count): only every count-th step starting at index is scanned
+        self.shard = shard
+        self.num_cycles = 0
+        self.cell_timestamps = CellTimestamp.get_timestamps()
+
+        # Queued calls of the old generation are dropped right away
+        scan_config.add_restart_listener(self.api.empty_work_queue)
+
+    def forget_cell_timestamps(self, cell_ids):
+        """Called when the rows of these cells weren't written, so they are
+        requested in full again."""
+        for cell_id in cell_ids:
+            self.cell_timestamps.pop(cell_id, None)
+
+    def in_shard(self, step):
+        index, count = self.shard
+        return step % count == index
+
+    def next_position(self, plan):
+        index, count = self.shard
+        for i in xrange(index, len(plan), count):
+            yield plan.step(i)
+
+    def callback(self, response_dict, token=None):
+        # Results of a cancelled generation are still stored (the data is
+        # valid), but they don't count towards the progress of the new scan.
+        current = token is None or not token.cancelled
 
-    @staticmethod
-    def callback(response_dict):
         if (not response_dict) or ('responses' in response_dict and not response_dict['responses']):
             log.info('Map Download failed. Trying again.')
             ScanMetrics.CONSECUTIVE_MAP_FAILS += 1
             return
 
         try:
-            parse_map(response_dict)
+            pokemons, pokestops, gyms = parse_map(response_dict)
+            cell_timestamps, deleted = parse_map_cells(response_dict)
+            self.ingest.put(pokemons, pokestops, gyms, cell_timestamps, deleted)
+            self.cell_timestamps.update(cell_timestamps)
             ScanMetrics.LAST_SUCCESSFUL_REQUEST = time.time()
             ScanMetrics.CONSECUTIVE_MAP_FAILS = 0
-            log.debug("Parsed & saved.")
+            log.debug("Parsed & queued for saving.")
         except Exception as e:  # make sure we dont crash in the main loop
             log.error(e)
             log.error('Unexpected error while parsing response.')
             log.error('Response dict: {}'.format(response_dict))
             ScanMetrics.CONSECUTIVE_MAP_FAILS += 1
         else:
+            if not current:
+                return
             ScanMetrics.STEPS_COMPLETED += 1
             if ScanMetrics.NUM_STEPS:
                 ScanMetrics.CURRENT_SCAN_PERCENT = float(ScanMetrics.STEPS_COMPLETED) / ScanMetrics.NUM_STEPS * 100
@@ -74,67 +134,192 @@ class Scanner(Thread):
                 ScanMetrics.CURRENT_SCAN_PERCENT = 0
             log.info('Completed {:5.2f}% of scan.'.format(ScanMetrics.CURRENT_SCAN_PERCENT))
 
-    def scan(self):
-        ScanMetrics.NUM_STEPS = len(self.scan_config.COVER)
+    def scan(self, token):
+        plan = self.scan_config.get_plan()
+        spawnpoints = None
+        if config['SCAN_MODE'] == 'spawn' or config['COVER_MODE'] == 'spawnpoints':
+            spawnpoints = learn_spawnpoints()
+
+        if config['COVER_MODE'] == 'spawnpoints':
+            # Every EXPLORE_EVERY cycles the whole area is swept to find new spawnpoints
+            explore = self.num_cycles % self.EXPLORE_EVERY == self.EXPLORE_EVERY - 1
+            self.num_cycles += 1
+            spawnpoint_plan = self.scan_config.get_spawnpoint_plan(spawnpoints)
+            if explore or spawnpoint_plan is None:
+                log.info('Exploring the whole area.')
+                self.sweep(plan, token)
+                return
+            plan = spawnpoint_plan
+
+        if config['SCAN_MODE'] == 'spawn':
+            schedule = SpawnSchedule(plan, spawnpoints)
+            if len(schedule):
+                self.scan_spawns(plan, schedule, token)
+                return
+            log.info('No spawnpoints known yet, scanning the whole area.')
+
+        self.sweep(plan, token)
+
+    def sweep(self, plan, token):
+        ScanMetrics.NUM_STEPS = len(xrange(self.shard[0], len(plan), self.shard[1]))
         log.info("Starting scan of {} locations".format(ScanMetrics.NUM_STEPS))
 
-        for i, next_pos in enumerate(self.next_position()):
+        # Steps are produced lazily, only a few per worker are queued at a
+        # time so restarts and reprioritising take effect immediately
+        high_water = max(self.QUEUED_STEPS_PER_WORKER * self.api.get_num_workers(), 2)
+        for i, (lat, lng, lat_i, lng_i, cell_ids) in enumerate(self.next_position(plan)):
+            while not token.cancelled and not self.api.wait_for_queue_space(high_water, timeout=2):
+                ScanMetrics.WORK_QUEUE = self.api.get_work_queue_stats()
+            if token.cancelled:
+                break
             log.debug('Scanning step {:d} of {:d}.'.format(i, ScanMetrics.NUM_STEPS))
-            log.debug('Scan location is {:f}, {:f}'.format(next_pos[0], next_pos[1]))
+            log.debug('Scan location is {:f}, {:f}'.format(lat, lng))
 
             # TODO: Add error throttle
 
-            cell_ids = get_cell_ids(next_pos[0], next_pos[1], radius=70)
-            timestamps = [0, ] * len(cell_ids)
+            # Only changes since the last response of every cell are returned
+            timestamps = [self.cell_timestamps.get(cell_id, 0) for cell_id in cell_ids]
             self.api.get_map_objects(
-                latitude=f2i(next_pos[0]),
-                longitude=f2i(next_pos[1]),
+                latitude=lat_i,
+                longitude=lng_i,
                 cell_id=cell_ids,
                 since_timestamp_ms=timestamps,
-                position=next_pos,
-                callback=Scanner.callback)
-
-        while not self.api.is_work_queue_empty():
-            # Location change
-            if self.scan_config.RESTART:
-                log.info("Restarting scan")
-                self.api.empty_work_queue()
-            else:
-                time.sleep(2)
-
-        #self.api.wait_until_done()  # Work queue empty != work done
+                position=(lat, lng, 0),
+                token=token,
+                callback=partial(self.callback, token=token))
+
+        # Woken up when the queue is done or emptied by a restart
+        while not token.cancelled and not self.api.wait_until_done(timeout=2):
+            ScanMetrics.WORK_QUEUE = self.api.get_work_queue_stats()
+        if token.cancelled:
+            log.info("Restarting scan")
+
+    def scan_spawns(self, plan, schedule, token):
+        upcoming = [(due, step) for due, step in schedule.upcoming(time.time()) if self.in_shard(step)]
+        ScanMetrics.NUM_STEPS = len(upcoming)
+        log.info("Starting spawn scan of {} steps in the next hour".format(len(upcoming)))
+
+        for due, step in upcoming:
+            while time.time() < due:
+                ScanMetrics.WORK_QUEUE = self.api.get_work_queue_stats()
+                if token.wait(min(2.0, due - time.time())):
+                    log.info("Restarting scan")
+                    return
+
+            lat, lng, lat_i, lng_i, cell_ids = plan.step(step)
+            log.debug('Scan location is {:f}, {:f}'.format(lat, lng))
+            self.api.get_map_objects(
+                latitude=lat_i,
+                longitude=lng_i,
+                cell_id=cell_ids,
+                since_timestamp_ms=[self.cell_timestamps.get(cell_id, 0) for cell_id in cell_ids],
+                position=(lat, lng, 0),
+                deadline=due,
+                token=token,
+                callback=partial(self.callback, token=token))
+
+    def warm_up(self, token):
+        """Waits until the quorum of the accounts is logged in or every
+        account failed to log in at least once."""
+        quorum = int(math.ceil(len(config['ACCOUNTS']) * config['LOGIN_QUORUM']))
+        start = time.time()
+        logins = self.api.get_login_stats()
+        while (not token.cancelled and logins['ready'] < quorum and
+               logins['logging-in'] > logins['failing']):
+            token.wait(0.5)
+            ScanMetrics.LOGINS = logins = self.api.get_login_stats()
+
+        log.info('{} of {} accounts ready after {:.1f}s, {} failing to log in, {} still logging in'.format(
+            logins['ready'], len(config['ACCOUNTS']), time.time() - start,
+            logins['failing'], logins['logging-in'] - logins['failing']))
+
+    def update_api_metrics(self):
+        # The pacing stats lock out the workers, so they aren't taken per response
+        while True:
+            ScanMetrics.PACING = self.api.get_pacing_stats()
+            ScanMetrics.LOGINS = self.api.get_login_stats()
+            time.sleep(self.API_METRICS_INTERVAL)
 
     def run(self):
+        metrics = Thread(target=self.update_api_metrics, name='api_metrics')
+        metrics.daemon = True
+        metrics.start()
+
         while True:
-            if self.scan_config.RESTART:
-                self.scan_config.RESTART = False
-                if self.scan_config.ACCOUNTS_CHANGED:
-                    self.scan_config.ACCOUNTS_CHANGED = False
-                    num_workers = min(max(int(math.ceil(len(config['ACCOUNTS']) / 23.0)), 3), 10)
-                    self.api.resize_workers(num_workers)
-                    self.api.add_accounts(config['ACCOUNTS'])
-
-                    ScanMetrics.NUM_THREADS = num_workers
-                    ScanMetrics.NUM_ACCOUNTS = len(config['ACCOUNTS'])
-
-            if (not self.scan_config.SCAN_LOCATIONS or
+            token = CancelToken(self.scan_config)
+            if self.scan_config.take_accounts_changed():
+                num_workers = min(max(int(math.ceil(len(config['ACCOUNTS']) / 23.0)), 3), 10)
+                self.api.resize_workers(num_workers)
+                self.api.set_accounts(config['ACCOUNTS'])
+
+                ScanMetrics.NUM_THREADS = num_workers
+                ScanMetrics.NUM_ACCOUNTS = len(config['ACCOUNTS'])
+                self.warm_up(token)
+
+            # COVER is only set once it's built for the current locations
+            if (not self.scan_config.COVER or
                     not config.get('ACCOUNTS', None)):
-                time.sleep(5)
+                # Adds nothing to the summed progress of the scan processes
+                ScanMetrics.NUM_STEPS = ScanMetrics.STEPS_COMPLETED = 0
+                token.wait()  # until the configuration changes
                 continue
             ScanMetrics.STEPS_COMPLETED = 0
             scan_start_time = time.time()
-            self.scan()
-            ScanMetrics.COMPLETE_SCAN_TIME = time.time() - scan_start_time
+            self.scan(token)
+            if not token.cancelled:
+                ScanMetrics.COMPLETE_SCAN_TIME = time.time() - scan_start_time
 
 
 class ScanConfig(object):
     SCAN_LOCATIONS = {}
     COVER = None
-
-    RESTART = True  # Triggered when the setup is changed due to user input
+    COVER_STATS = {'points': 0, 'build_time': 0.0}
+    COVER_KEY = None
+    PLAN = None
+    PLAN_LOCK = Lock()
+    SPAWNPOINT_PLAN = None
+    SPAWNPOINT_PLAN_SOURCE = None  # (cover key, spawnpoint ids) it was built for
+
+    # Every change due to user input starts a new generation, which cancels
+    # the running scan
+    GENERATION = 0
+    CHANGED = Condition()
     ACCOUNTS_CHANGED = True
-
-    def update_scan_locations(self, scan_locations):
+    RESTART_LISTENERS = []
+
+    def add_restart_listener(self, listener):
+        self.RESTART_LISTENERS.append(listener)
+
+    def restart(self, accounts_changed=False):
+        with self.CHANGED:
+            ScanConfig.GENERATION += 1
+            if accounts_changed:
+                ScanConfig.ACCOUNTS_CHANGED = True
+            self.CHANGED.notify_all()
+        for listener in self.RESTART_LISTENERS:
+            listener()
+
+    def take_accounts_changed(self):
+        with self.CHANGED:
+            changed, ScanConfig.ACCOUNTS_CHANGED = ScanConfig.ACCOUNTS_CHANGED, False
+            return changed
+
+    def wait_for_change(self, generation, timeout=None):
+        """Waits until the generation differs from the given one or timeout
+        seconds passed. Returns True if it changed."""
+        end = time.time() + timeout if timeout is not None else None
+        with self.CHANGED:
+            while self.GENERATION == generation:
+                if end is None:
+                    self.CHANGED.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.CHANGED.wait(remaining)
+            return True
+
+    def update_scan_locations(self, scan_locations, plan=None):
         location_names = set([])
         # Add new locations
         for scan_location in scan_locations:
@@ -152,11 +337,11 @@ class ScanConfig(object):
             location_names.add(scan_location['location'])
 
         # Remove old locations
-        for location_name in self.SCAN_LOCATIONS:
+        for location_name in list(self.SCAN_LOCATIONS):
             if location_name not in location_names:
                 del self.SCAN_LOCATIONS[location_name]
 
-        self._update_cover()
+        self._update_cover(plan)
 
     def add_scan_location(self, lat, lng, radius):
         scan_location = {
@@ -177,37 +362,66 @@ class ScanConfig(object):
                 self._update_cover()
                 return
 
-    def _update_cover(self):
-        cover = []
-
+    def _update_cover(self, plan=None):
         # Go backwards through locations so that last location
         # will be scanned first
-        for scan_location in reversed(self.SCAN_LOCATIONS.values()):
-            lat = scan_location["latitude"]
-            lng = scan_location["longitude"]
-            radius = scan_location["radius"]
-
-            d = math.sqrt(3) * 70
-            points = [[{'lat2': lat, 'lon2': lng, 's': 0}]]
-
-            # The lines below are magic. Don't touch them.
-            for i in xrange(1, maxint):
-                oor_counter = 0
-
-                points.append([])
-                for j in range(0, 6 * i):
-                    p = points[i - 1][(j - j / i - 1 + (j % i == 0))]
-                    p_new = Geodesic.WGS84.Direct(p['lat2'], p['lon2'], (j+i-1)/i * 60, d)
-                    p_new['s'] = Geodesic.WGS84.Inverse(p_new['lat2'], p_new['lon2'], lat, lng)['s12']
-                    points[i].append(p_new)
-
-                    if p_new['s'] > radius:
-                        oor_counter += 1
+        scan_locations = list(reversed(self.SCAN_LOCATIONS.values()))
+        cover, cover_stats = build_cover(scan_locations)
+        with self.PLAN_LOCK:
+            self.COVER, self.COVER_STATS = cover, cover_stats
+            self.COVER_KEY = self.locations_hash(scan_locations)
+            # A plan compiled by another process can be passed in
+            self.PLAN = plan if plan is not None and plan.key == self.COVER_KEY else None
+        self.restart()
 
-                if oor_counter == 6 * i:
-                    break
-
-            cover.extend({"lat": p['lat2'], "lng": p['lon2']}
-                         for sublist in points for p in sublist if p['s'] < radius)
-
-        self.COVER = cover
+    @staticmethod
+    def locations_hash(scan_locations):
+        h = hashlib.sha1()
+        for scan_location in scan_locations:
+            h.update('{!r},{!r},{!r};'.format(scan_location['latitude'],
+                                              scan_location['longitude'],
+                                              scan_location['radius']))
+        return h.hexdigest()
+
+    def get_spawnpoint_plan(self, spawnpoints):
+        """Returns the plan of the spawnpoint cover, or None if no spawnpoints
+        are known within the scan locations. Only rebuilt (outside of the
+        lock) when the cover or the set of spawnpoints changed."""
+        spawnpoint_ids = frozenset(s.spawnpoint_id for s in spawnpoints)
+        with self.PLAN_LOCK:
+            source = (self.COVER_KEY, spawnpoint_ids)
+            if self.SPAWNPOINT_PLAN_SOURCE == source:
+                return self.SPAWNPOINT_PLAN
+            scan_locations = list(reversed(self.SCAN_LOCATIONS.values()))
+            num_hex_points = len(self.COVER or ())
+
+        cover, cover_stats = build_spawnpoint_cover(
+            scan_locations, [(s.latitude, s.longitude) for s in spawnpoints], num_hex_points)
+        plan = None
+        if cover is not None:
+            h = hashlib.sha1(source[0] or '')
+            for spawnpoint_id in sorted(spawnpoint_ids):
+                h.update(spawnpoint_id)
+            # Not cached on disk, the spawnpoints change with every new find
+            plan = ScanPlan.get(h.hexdigest(), cover)
+
+        with self.PLAN_LOCK:
+            if self.COVER_KEY == source[0]:
+                self.SPAWNPOINT_PLAN, self.SPAWNPOINT_PLAN_SOURCE = plan, source
+                if cover_stats is not None:
+                    self.COVER_STATS = dict(self.COVER_STATS, spawnpoint_cover=cover_stats)
+        return plan
+
+    def get_plan(self):
+        # Compiled lazily by the scanner thread and outside of the lock, so
+        # cover changes return immediately
+        with self.PLAN_LOCK:
+            if self.PLAN is not None and self.PLAN.key == self.COVER_KEY:
+                return self.PLAN
+            key, cover = self.COVER_KEY, self.COVER
+
+        plan = ScanPlan.get(key, cover, config['CACHE_PATH'])
+        with self.PLAN_LOCK:
+            if self.COVER_KEY == key:
+                self.PLAN = plan
+        return plan
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import multiprocessing
+import time
+from threading import Thread, Event
+
+from .pgoapi import RpcApi
+from .scan import Scanner, ScanConfig, ScanMetrics
+from . import config
+
+log = logging.getLogger(__name__)
+
+METRICS_INTERVAL = 2.0
+SUMMED_METRICS = ['STEPS_COMPLETED', 'NUM_STEPS', 'NUM_THREADS', 'NUM_ACCOUNTS', 'CONSECUTIVE_MAP_FAILS']
+
+
+class ShardIngest(object):
+    """Stands in for the IngestWriter in a shard process and sends the rows
+    to the writer of the main process."""
+
+    def __init__(self, results):
+        self.results = results
+
+    def put(self, *rows):
+        # Blocks when the main process falls behind, like IngestWriter.put
+        self.results.put(('rows', rows))
+
+
+def get_metrics():
+    return dict((name, getattr(ScanMetrics, name)) for name in
+                SUMMED_METRICS + ['LAST_SUCCESSFUL_REQUEST', 'COMPLETE_SCAN_TIME', 'WORK_QUEUE', 'PACING', 'LOGINS'])
+
+
+def get_share(index, num_shards, accounts):
+    """Returns the accounts and the (index, count) shard of the steps of the
+    index-th process.
+
+    The steps are only split among the processes that get accounts, with
+    fewer accounts than processes the others are idle.
+    """
+    num_active = min(num_shards, len(accounts))
+    if index >= num_active:
+        if accounts:
+            log.warning('Scan process {} is idle, there are only {} accounts for {} processes'.format(
+                index, len(accounts), num_shards))
+        return [], (index, num_shards)
+    return accounts[index::num_shards], (index, num_active)
+
+
+def run_shard(index, num_shards, scan_config, results, control):
+    """Main function of a shard process.
+
+    Scans its share of the steps of the plan with its share of the
+    accounts, sends parsed rows and its ScanMetrics to the main process and
+    applies the configurations it receives on `control`. Cells whose rows
+    couldn't be written are requested in full again.
+    """
+    RpcApi.RAW_CAPTURE = None  # the capture thread lives in the main process
+    ScanConfig.RESTART_LISTENERS = []
+
+    config['ACCOUNTS'], shard = get_share(index, num_shards, config['ACCOUNTS'])
+    scanner = Scanner(scan_config, ShardIngest(results), shard=shard)
+    scanner.start()
+
+    def report_metrics():
+        while True:
+            results.put(('metrics', index, get_metrics()))
+            time.sleep(METRICS_INTERVAL)
+
+    reporter = Thread(target=report_metrics, name='shard_metrics')
+    reporter.daemon = True
+    reporter.start()
+
+    while True:
+        message = control.get()
+        try:
+            if message[0] == 'forget_cells':
+                scanner.forget_cell_timestamps(message[1])
+                continue
+
+            scan_locations, accounts, plan = message[1:]
+            accounts, scanner.shard = get_share(index, num_shards, accounts)
+            accounts_changed = (set(a['username'] for a in accounts) !=
+                                set(a['username'] for a in config['ACCOUNTS']))
+            config['ACCOUNTS'] = accounts
+            scan_config.update_scan_locations(scan_locations, plan=plan)
+            scan_config.restart(accounts_changed=accounts_changed)
+        except Exception as e:  # keep scanning with the last configuration
+            log.exception('Could not apply message of main process: {}'.format(e))
+
+
+class ShardManager(Thread):
+    """Runs the scan in num_shards processes.
+
+    Every process has its own PGoApi with a share of the accounts and scans
+    its share of the plan, so signing and parsing use all cores. Their rows
+    are written by the ingest writer of this process and their ScanMetrics
+    are summed up here.
+
+    The scan plan is compiled once in this process and handed to the
+    processes. They are forked on creation, so the manager has to be created
+    before this process opens a database connection.
+    """
+
+    def __init__(self, scan_config, ingest, num_shards):
+        Thread.__init__(self)
+        self.daemon = True
+        self.name = 'shard_manager'
+
+        self.scan_config = scan_config
+        self.ingest = ingest
+        self.num_shards = num_shards
+
+        self._results = multiprocessing.Queue(100)
+        self._controls = []
+        self._metrics = {}
+        self._config_changed = Event()
+
+        # Inherited by the processes
+        if scan_config.COVER:
+            scan_config.get_plan()
+
+        for index in xrange(num_shards):
+            control = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_shard, name='shard-{}'.format(index),
+                                              args=(index, num_shards, scan_config, self._results, control))
+            process.daemon = True
+            process.start()
+            self._controls.append(control)
+        log.info('Started {} scan processes'.format(num_shards))
+
+        pusher = Thread(target=self.push_configs, name='shard_config')
+        pusher.daemon = True
+        pusher.start()
+        scan_config.add_restart_listener(self._config_changed.set)
+        ingest.add_failure_listener(self.forget_cells)
+
+    def push_configs(self):
+        # Restarts are triggered by requests, the plan is compiled here
+        while True:
+            self._config_changed.wait()
+            self._config_changed.clear()
+            scan_locations = self.scan_config.SCAN_LOCATIONS.values()
+            plan = self.scan_config.get_plan() if self.scan_config.COVER else None
+            for control in self._controls:
+                control.put(('config', scan_locations, config['ACCOUNTS'], plan))
+
+    def forget_cells(self, cell_ids):
+        for control in self._controls:
+            control.put(('forget_cells', cell_ids))
+
+    def run(self):
+        while True:
+            message = self._results.get()
+            try:
+                if message[0] == 'rows':
+                    self.ingest.put(*message[1])
+                elif message[0] == 'metrics':
+                    self._metrics[message[1]] = message[2]
+                    self.aggregate_metrics()
+            except Exception as e:  # never stop reading, the shards would block
+                log.error('Could not handle message of scan process: {}'.format(e))
+
+    def aggregate_metrics(self):
+        metrics = self._metrics.values()
+        for name in SUMMED_METRICS:
+            setattr(ScanMetrics, name, sum(m[name] for m in metrics))
+
+        last_requests = [m['LAST_SUCCESSFUL_REQUEST'] for m in metrics]
+        if any(t > 0 for t in last_requests):
+            ScanMetrics.LAST_SUCCESSFUL_REQUEST = max(last_requests)
+        elif -1 in last_requests:
+            ScanMetrics.LAST_SUCCESSFUL_REQUEST = -1
+        else:
+            ScanMetrics.LAST_SUCCESSFUL_REQUEST = 0
+
+        ScanMetrics.COMPLETE_SCAN_TIME = max(m['COMPLETE_SCAN_TIME'] for m in metrics)
+        if ScanMetrics.NUM_STEPS:
+            ScanMetrics.CURRENT_SCAN_PERCENT = float(ScanMetrics.STEPS_COMPLETED) / ScanMetrics.NUM_STEPS * 100
+        else:
+            ScanMetrics.CURRENT_SCAN_PERCENT = 0
+
+        work_queue = {}
+        for m in metrics:
+            for name, value in m['WORK_QUEUE'].iteritems():
+                if name == 'depth':
+                    work_queue[name] = work_queue.get(name, 0) + value
+                else:
+                    work_queue[name] = max(work_queue.get(name, 0.0), value)
+        ScanMetrics.WORK_QUEUE = work_queue
+
+        # Every process paces its own accounts
+        pacing = {'global-requests-per-hour': None, 'requests-per-hour': 0.0, 'accounts': {}}
+        for m in metrics:
+            if not m['PACING']:
+                continue
+            if m['PACING']['global-requests-per-hour'] is not None:
+                pacing['global-requests-per-hour'] = (
+                    (pacing['global-requests-per-hour'] or 0.0) + m['PACING']['global-requests-per-hour'])
+            pacing['requests-per-hour'] += m['PACING']['requests-per-hour']
+            pacing['accounts'].update(m['PACING']['accounts'])
+        ScanMetrics.PACING = pacing
+
+        logins = {}
+        for m in metrics:
+            for name, value in m['LOGINS'].iteritems():
+                logins[name] = logins.get(name, 0) + value
+        ScanMetrics.LOGINS = logins
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from .cover import SCAN_RADIUS, nearest
+from .models import SpawnpointSecond
+
+log = logging.getLogger(__name__)
+
+Spawnpoint = namedtuple('Spawnpoint', ['spawnpoint_id', 'latitude', 'longitude', 'spawn_second'])
+
+
+def learn_spawnpoints():
+    """Returns the known spawnpoints with their spawn second of the hour.
+
+    The spawn second is derived from the disappear time of every pokemon
+    seen at a spawnpoint; the most frequent one wins. Read from the
+    SpawnpointSecond aggregate, not the pokemon history.
+    """
+    start = time.time()
+    seconds = {}
+    positions = {}
+    query = (SpawnpointSecond
+             .select(SpawnpointSecond.spawnpoint_id, SpawnpointSecond.latitude, SpawnpointSecond.longitude,
+                     SpawnpointSecond.spawn_second, SpawnpointSecond.count)
+             .tuples())
+    for spawnpoint_id, lat, lng, second, count in query.iterator():
+        seconds.setdefault(spawnpoint_id, {})[second] = count
+        positions[spawnpoint_id] = (lat, lng)
+
+    spawnpoints = [Spawnpoint(spawnpoint_id, lat, lng, max(seconds[spawnpoint_id], key=seconds[spawnpoint_id].get))
+                   for spawnpoint_id, (lat, lng) in positions.iteritems()]
+    log.info('Learned {} spawnpoints in {:.2f}s'.format(len(spawnpoints), time.time() - start))
+    return spawnpoints
+
+
+class SpawnSchedule(object):
+    """Hourly scan times of the plan steps that cover known spawnpoints.
+
+    Every spawnpoint is assigned to the nearest step within the scan radius.
+    A step is scanned `delay` seconds after its spawnpoints are due; spawns
+    of one step that are less than `window` seconds apart share a scan.
+    """
+
+    def __init__(self, plan, spawnpoints, delay=10, window=60):
+        self.events = []  # (second of the hour, step)
+        self.num_spawnpoints = 0
+
+        if not spawnpoints or not len(plan):
+            return
+
+        steps, distances = nearest(np.array([s.latitude for s in spawnpoints]),
+                                   np.array([s.longitude for s in spawnpoints]),
+                                   plan.lats, plan.lngs)
+        step_seconds = {}
+        for spawnpoint, step, distance in zip(spawnpoints, steps.tolist(), distances.tolist()):
+            if distance <= SCAN_RADIUS:
+                step_seconds.setdefault(step, []).append(spawnpoint.spawn_second)
+                self.num_spawnpoints += 1
+
+        for step, seconds in step_seconds.iteritems():
+            seconds.sort()
+            first = last = seconds[0]
+            for second in seconds[1:]:
+                if second - first > window:
+                    self.events.append(((last + delay) % 3600, step))
+                    first = second
+                last = second
+            self.events.append(((last + delay) % 3600, step))
+        self.events.sort()
+
+        log.info('Scheduled {} scans per hour of {} steps for {} spawnpoints'.format(
+            len(self.events), len(step_seconds), self.num_spawnpoints))
+
+    def __len__(self):
+        return len(self.events)
+
+    def upcoming(self, now):
+        """Returns the (due time, step) of the next hour, starting at now."""
+        hour = now - now % 3600
+        return sorted((hour + second + (3600 if hour + second < now else 0), step)
+                      for second, step in self.events)
@@ -29,6 +29,21 @@ def get_args():
     parser.add_argument('--db', help='Connection String to be used. (default: sqlite)',
                         default='sqlite')
     parser.add_argument('-d', '--debug', type=str.lower, help='Debug Level [info|debug]', default=None)
+    parser.add_argument('--ingest-batch-size', type=int, help='Maximum number of rows written in one transaction', default=500)
+    parser.add_argument('--ingest-flush-interval', type=float, help='Maximum seconds parsed rows wait before being written', default=1.0)
+    parser.add_argument('--capture-raw', help='Write raw RPC responses to this file (rotated)', default=None)
+    parser.add_argument('--capture-max-mb', type=int, help='Size of one raw capture file in MB', default=64)
+    parser.add_argument('--scan-mode', choices=['hex', 'spawn'], default='hex',
+                        help='hex: sweep the whole area, spawn: scan known spawnpoints just after they spawn')
+    parser.add_argument('--cover-mode', choices=['hex', 'spawnpoints'], default='hex',
+                        help='hex: scan positions cover the whole area, spawnpoints: fewest positions reaching all known spawnpoints')
+    parser.add_argument('--scan-processes', type=int, default=1,
+                        help='Split the scan and the accounts across this many processes')
+    parser.add_argument('--login-threads', type=int, default=4,
+                        help='Number of accounts logging in at the same time (per scan process)')
+    parser.add_argument('--login-quorum', type=float, default=0.5,
+                        help='Share of the accounts that has to be logged in before the scan starts')
+    parser.add_argument('--rebuild-stats', action='store_true', help='Recount the pokemon stats, heatmap and spawnpoints from the pokemon history and exit')
 
     return parser.parse_args()
 
@@ -11,8 +11,13 @@ from threading import Thread
 
 from pogom import config
 from pogom.app import Pogom
-from pogom.models import create_tables
+from pogom.models import create_tables, PokemonStats, HeatmapCell, SpawnpointSecond
+from pogom.ingest import IngestWriter
+from pogom.live import LiveState
+from pogom.pgoapi import RpcApi
+from pogom.pgoapi.raw_capture import RawCapture
 from pogom.scan import Scanner, ScanConfig
+from pogom.shard import ShardManager
 from pogom.utils import get_args, get_encryption_lib_path
 
 log = logging.getLogger(__name__)
@@ -24,6 +29,7 @@ def read_config(scan_config):
 
     if os.path.isfile(config_path):
         config['CONFIG_PATH'] = config_path
+    config['CACHE_PATH'] = os.path.join(os.path.dirname(config_path), 'cache')
 
     try:
         with open(config_path, "r") as f:
@@ -35,6 +41,8 @@ def read_config(scan_config):
     config['GOOGLEMAPS_KEY'] = c.get('GOOGLEMAPS_KEY', None)
     config['CONFIG_PASSWORD'] = c.get('CONFIG_PASSWORD', None)
     config['ACCOUNTS'] = c.get('ACCOUNTS', [])
+    # Access tokens are cached (encrypted with this key) only if it's set
+    config['TOKEN_CACHE_KEY'] = c.get('TOKEN_CACHE_KEY', None)
     scan_config.update_scan_locations(c.get('SCAN_LOCATIONS', {}))
 
     if config.get('CONFIG_PASSWORD', None):
@@ -65,13 +73,41 @@ if __name__ == '__main__':
         logging.getLogger("werkzeug").setLevel(logging.INFO)
 
     create_tables()
+    if args.rebuild_stats:
+        PokemonStats.rebuild()
+        HeatmapCell.rebuild()
+        SpawnpointSecond.rebuild()
+        sys.exit(0)
+
     scan_config = ScanConfig()
     read_config(scan_config)
     config['SIGNATURE_LIB_PATH'] = get_encryption_lib_path()
+    config['SCAN_MODE'] = args.scan_mode
+    config['COVER_MODE'] = args.cover_mode
+    config['LOGIN_THREADS'] = args.login_threads
+    config['LOGIN_QUORUM'] = args.login_quorum
+
+    ingest = IngestWriter(max_rows=args.ingest_batch_size, max_latency=args.ingest_flush_interval)
+
+    # Forks the scan processes, before any thread or database connection exists
+    if args.scan_processes > 1:
+        scanner = ShardManager(scan_config, ingest, args.scan_processes)
+
+    if args.capture_raw:
+        RpcApi.RAW_CAPTURE = RawCapture(args.capture_raw, max_bytes=args.capture_max_mb * 1024 * 1024)
+        RpcApi.RAW_CAPTURE.start()
+
+    live_state = LiveState()
+    live_state.load()
+
+    ingest.add_listener(live_state.update)
+    ingest.start()
 
-    scanner = Scanner(scan_config)
+    if args.scan_processes <= 1:
+        scanner = Scanner(scan_config, ingest)
+        ingest.add_failure_listener(scanner.forget_cell_timestamps)
     scanner.start()
 
-    app = Pogom(scan_config, __name__)
+    app = Pogom(scan_config, live_state, __name__)
     config['ROOT_PATH'] = app.root_path
     app.run(threaded=True, debug=args.debug, host=args.host, port=args.port)
@@ -67,22 +67,10 @@ $selectExclude.on("change", function (e) {
     excludedPokemon = $selectExclude.val().map(Number);
     localStorage.excludedPokemon = JSON.stringify(excludedPokemon);
     clearStaleMarkers();
+    resetMapDelta();  // previously excluded pokemon have to be fetched again
 });
 
-$heatMapMons.on("change", function (e){
-    var heatMapMons = $heatMapMons.val().map(Number);
-
-    $.each(pokeList, function(i, poke) {
-        if (typeof google === 'undefined') return;
-        if (!heatMapData[poke.id]) return;
-
-        if (heatMapMons.indexOf(parseInt(poke.id)) != -1) {
-            heatMapData[poke.id]['map'].setMap(map);
-        } else {
-            heatMapData[poke.id]['map'].setMap(null);
-        }
-    });
-});
+$heatMapMons.on("change", updateHeatMap);
 
 // Stolen from http://www.quirksmode.org/js/cookies.html
 function readCookie(name) {
@@ -104,46 +92,57 @@ function is_logged_in(){
     }
 }
 
-function drawHeatMap(index, item) {
-    heatMapData[index]['map'] =  new google.maps.visualization.HeatmapLayer({
-        data: item.data,
-        dissipating: true,
-        map: null
-    })
-}
+// Only the selected pokemon are requested, aggregated for the current zoom
+function updateHeatMap() {
+    if (typeof google === 'undefined' || !map) return;
 
+    var heatMapMons = $heatMapMons.val() || [];
+    if (heatMapMons.length === 0) {
+        $.each(heatMapData, function (id, layer) {
+            layer.setMap(null);
+        });
+        heatMapData = {};
+        return;
+    }
+
+    var data = mapBounds();
+    data.zoom = map.getZoom();
+    data.pokemon = heatMapMons.join(',');
 
-function updateHeatMap() {
     $.ajax({
         url: "heatmap-data",
         type: 'GET',
-        data: {'pokemon': localStorage.displayPokemons},
+        data: data,
         dataType: "json"
-    }).done(function(pokemons) {
-        // Google's heatmap example
-        $.each(pokemons, function(i, item){
-            if (item.count == 0 ) {
-                return false;
+    }).done(function(cells) {
+        var points = {};
+        $.each(cells, function(i, item){
+            if (!points[item.pokemon_id]) {
+                points[item.pokemon_id] = [];
             }
-            var latLng = new google.maps.LatLng(item.latitude, item.longitude);
-            var magnitude = item.count;
-            var weightedLoc = {
-                location: latLng,
-                weight: magnitude
+            points[item.pokemon_id].push({
+                location: new google.maps.LatLng(item.latitude, item.longitude),
+                weight: item.count
+            });
+        });
+
+        $.each(heatMapData, function (id, layer) {
+            if (!points[id]) {
+                layer.setMap(null);
+                delete heatMapData[id];
             }
-            if(heatMapData[item.pokemon_id]) {
-                heatMapData[item.pokemon_id]['data'].push(weightedLoc);
+        });
+        $.each(points, function (id, data) {
+            if (heatMapData[id]) {
+                heatMapData[id].setData(data);
             } else {
-                heatMapData[item.pokemon_id] = {
-                    name: item.name,
-                    data: [weightedLoc]
-                };
+                heatMapData[id] = new google.maps.visualization.HeatmapLayer({
+                    data: data,
+                    dissipating: true,
+                    map: map
+                });
             }
         });
-        $.each(heatMapData, function (i, item) {
-            drawHeatMap(i, item);
-        })
-
     });
 }
 
@@ -166,8 +165,11 @@ function initMap() {
     });
 
     updateScanLocations(initialScanLocations);
-    updateMap();
-    updateHeatMap();
+
+    // Only the visible part of the map is requested, reload after panning/zooming
+    google.maps.event.addListener(map, 'idle', updateMap);
+    google.maps.event.addListener(map, 'idle', updateHeatMap);
+    initEventStream();
 
     if(is_logged_in()) {
         // on click listener for
@@ -277,6 +279,7 @@ function gymLabel(team_name, team_id, gym_points) {
 
 
 var map_pokemons = {}; // dict containing all pokemons on the map.
+var map_pokestops = {};
 var map_gyms = {};
 var gym_types = [ "Uncontested", "Mystic", "Valor", "Instinct" ];
 
@@ -458,63 +461,119 @@ function updateScanLocations(updatedScanLocations) {
 
 //               'pokestops': document.getElementById('pokestops-checkbox').checked,
 //               'pokestops-lured': document.getElementById('pokestops-lured-checkbox').checked,
-function updateMap() {
-    $.ajax({
-        url: "map-data",
-        type: 'GET',
-        data: {'pokemon': localStorage.displayPokemons,
-               'gyms': localStorage.displayGyms},
-        dataType: "json"
-    }).done(function(result) {
-        statusLabels(result["server_status"]);
+function mapBounds() {
+    var bounds = map.getBounds();
+    if (!bounds) {
+        return {};
+    }
+    return {'swLat': bounds.getSouthWest().lat(),
+            'swLng': bounds.getSouthWest().lng(),
+            'neLat': bounds.getNorthEast().lat(),
+            'neLng': bounds.getNorthEast().lng()};
+}
 
-        updateScanLocations(result['scan_locations']);
+// Sequence number of the last response, used to only fetch changes as long
+// as the query (bounds and filters) stays the same.
+var lastSeq = null;
+var lastQuery = null;
 
-        $.each(result.pokemons, function(i, item){
-            if (!document.getElementById('pokemon-checkbox').checked) {
-                return false; // in case the checkbox was unchecked in the meantime.
-            }
+function resetMapDelta() {
+    lastSeq = null;
+    lastQuery = null;
+}
 
-            if (!(item.encounter_id in map_pokemons) &&
-                    excludedPokemon.indexOf(item.pokemon_id) < 0) {
-                // add marker to map and item to dict
-                if (item.marker) item.marker.setMap(null);
-                item.marker = setupPokemonMarker(item);
-                map_pokemons[item.encounter_id] = item;
-                notify(item);
-            } else if (item.encounter_id in map_pokemons  && 
-                    map_pokemons[item.encounter_id].disappear_time != item.disappear_time) {
-                //update label
-                map_pokemons[item.encounter_id].disappear_time = item.disappear_time;
-                var label = pokemonLabel(item.pokemon_name, item.pokemon_id, item.disappear_time, item.latitude, item.longitude);
-                map_pokemons[item.encounter_id].marker.infoWindow.setContent(label);
-            }
+function removeMarker(items, key) {
+    if (key in items) {
+        items[key].marker.setMap(null);
+        delete items[key];
+    }
+}
+
+// Adds/updates the markers of new or changed items and removes deleted ones.
+// Used for /map-data responses and for events of the stream.
+function applyMapChanges(result) {
+    if (result.removed) {
+        $.each(result.removed.pokemons || [], function(i, key) {
+            removeMarker(map_pokemons, key);
+        });
+        $.each(result.removed.pokestops || [], function(i, key) {
+            removeMarker(map_pokestops, key);
         });
+        $.each(result.removed.gyms || [], function(i, key) {
+            removeMarker(map_gyms, key);
+        });
+    }
 
-        $.each(result.gyms, function(i, item){
-            if (!document.getElementById('gyms-checkbox').checked) {
-                return false; // in case the checkbox was unchecked in the meantime.
-            }
+    $.each(result.pokemons, function(i, item){
+        if (!document.getElementById('pokemon-checkbox').checked) {
+            return false; // in case the checkbox was unchecked in the meantime.
+        }
 
-            if (item.gym_id in map_gyms) {
-                // if team has changed, create new marker (new icon)
-                if (map_gyms[item.gym_id].team_id != item.team_id) {
-                    map_gyms[item.gym_id].marker.setMap(null);
-                    map_gyms[item.gym_id].marker = setupGymMarker(item);
-                } else { // if it hasn't changed generate new label only (in case prestige has changed)
-                    map_gyms[item.gym_id].marker.infoWindow = new google.maps.InfoWindow({
-                        content: gymLabel(gym_types[item.team_id], item.team_id, item.gym_points),
-                        disableAutoPan: true
-                    });
-                }
-            }
-            else { // add marker to map and item to dict
-                if (item.marker) item.marker.setMap(null);
-                item.marker = setupGymMarker(item);
-                map_gyms[item.gym_id] = item;
+        if (!(item.encounter_id in map_pokemons) &&
+                excludedPokemon.indexOf(item.pokemon_id) < 0) {
+            // add marker to map and item to dict
+            if (item.marker) item.marker.setMap(null);
+            item.marker = setupPokemonMarker(item);
+            map_pokemons[item.encounter_id] = item;
+            notify(item);
+        } else if (item.encounter_id in map_pokemons  && 
+                map_pokemons[item.encounter_id].disappear_time != item.disappear_time) {
+            //update label
+            map_pokemons[item.encounter_id].disappear_time = item.disappear_time;
+            var label = pokemonLabel(item.pokemon_name, item.pokemon_id, item.disappear_time, item.latitude, item.longitude);
+            map_pokemons[item.encounter_id].marker.infoWindow.setContent(label);
+        }
+    });
+
+    $.each(result.gyms, function(i, item){
+        if (!document.getElementById('gyms-checkbox').checked) {
+            return false; // in case the checkbox was unchecked in the meantime.
+        }
+
+        if (item.gym_id in map_gyms) {
+            // if team has changed, create new marker (new icon)
+            if (map_gyms[item.gym_id].team_id != item.team_id) {
+                map_gyms[item.gym_id].marker.setMap(null);
+                map_gyms[item.gym_id].marker = setupGymMarker(item);
+                map_gyms[item.gym_id].team_id = item.team_id;
+            } else { // if it hasn't changed generate new label only (in case prestige has changed)
+                map_gyms[item.gym_id].marker.infoWindow = new google.maps.InfoWindow({
+                    content: gymLabel(gym_types[item.team_id], item.team_id, item.gym_points),
+                    disableAutoPan: true
+                });
             }
-        });
+        }
+        else { // add marker to map and item to dict
+            if (item.marker) item.marker.setMap(null);
+            item.marker = setupGymMarker(item);
+            map_gyms[item.gym_id] = item;
+        }
+    });
+}
+
+function updateMap() {
+    if (!map) {
+        return;
+    }
+
+    var data = $.extend({'pokemon': localStorage.displayPokemons,
+                         'gyms': localStorage.displayGyms}, mapBounds());
+    var query = JSON.stringify(data);
+    if (query === lastQuery && lastSeq !== null) {
+        data['since'] = lastSeq;
+    }
+
+    $.ajax({
+        url: "map-data",
+        type: 'GET',
+        data: data,
+        dataType: "json"
+    }).done(function(result) {
+        lastSeq = result.seq;
+        lastQuery = query;
 
+        updateScanLocations(result['scan_locations']);
+        applyMapChanges(result);
         clearStaleMarkers();
     }).fail(function() {
         $lastRequestLabel.removeClass('label-success label-warning');
@@ -523,7 +582,63 @@ function updateMap() {
     });
 }
 
-window.setInterval(updateMap, 10000);
+function updateStatus() {
+    $.ajax({
+        url: "status",
+        type: 'GET',
+        dataType: "json"
+    }).done(statusLabels);
+}
+
+var pollInterval = null;
+
+// The status is polled with the map unless the stream pushes it.
+function startPolling(interval, withStatus) {
+    if (pollInterval) {
+        window.clearInterval(pollInterval);
+    }
+    pollInterval = window.setInterval(function() {
+        updateMap();
+        if (withStatus) {
+            updateStatus();
+        }
+    }, interval);
+}
+
+function inViewport(item) {
+    var bounds = map.getBounds();
+    return !bounds || bounds.contains(new google.maps.LatLng(item.latitude, item.longitude));
+}
+
+// Pushes new sightings, fort changes and the scan status as they happen.
+// While the stream is connected the map is only polled rarely to resync,
+// without it (or without EventSource support) it is polled every 10 seconds.
+function initEventStream() {
+    if (typeof EventSource === 'undefined') {
+        return;
+    }
+
+    var source = new EventSource('stream');
+    source.onopen = function() {
+        startPolling(60000);
+        updateMap();  // catch up on changes missed while disconnected
+    };
+    source.onerror = function() {
+        startPolling(10000, true);
+    };
+    source.addEventListener('map', function(e) {
+        var changes = JSON.parse(e.data);
+        changes.pokemons = $.grep(changes.pokemons || [], inViewport);
+        changes.gyms = $.grep(changes.gyms || [], inViewport);
+        applyMapChanges(changes);
+    });
+    source.addEventListener('status', function(e) {
+        statusLabels(JSON.parse(e.data));
+    });
+}
+
+startPolling(10000, true);
+updateStatus();
 
 $('#gyms-checkbox').change(function() {
     localStorage.displayGyms = this.checked;
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from Queue import Queue
+from base64 import b64encode
+from datetime import datetime, timedelta
+
+sys.argv = sys.argv[:1]  # pogom.models parses the command line on import
+
+from pogom.ingest import IngestWriter
+from pogom.models import db, create_tables, PokemonRow, Pokemon, PokemonStats, HeatmapCell, \
+    SpawnpointSecond, SchemaVersion
+from pogom.spawns import learn_spawnpoints
+
+
+class IngestStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        db.init(os.path.join(self.directory, 'pogom.db'))
+        create_tables()
+        self.writer = IngestWriter()
+
+    def tearDown(self):
+        db.close()
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def sighting(encounter_id, pokemon_id=16):
+        # Keyed by the raw id like parse_map does
+        return {encounter_id: PokemonRow(
+            b64encode(str(encounter_id)), '47c3', pokemon_id, 48.1, 11.5,
+            datetime.utcnow().replace(microsecond=0) + timedelta(minutes=10))}
+
+    def test_resighting_is_counted_once(self):
+        self.writer.flush(self.sighting(1234567890123), {}, {})
+        self.writer.flush(self.sighting(1234567890123), {}, {})
+
+        self.assertEqual(Pokemon.select().count(), 1)
+        self.assertEqual(PokemonStats.get(PokemonStats.pokemon_id == 16).count, 1)
+        self.assertEqual([c['count'] for c in HeatmapCell.get_heatmap([16])], [1])
+
+    def test_new_sighting_is_counted(self):
+        self.writer.flush(self.sighting(1), {}, {})
+        self.writer.flush(self.sighting(2), {}, {})
+
+        self.assertEqual(PokemonStats.get(PokemonStats.pokemon_id == 16).count, 2)
+
+    def test_added_aggregates_match_a_rebuild(self):
+        disappear_time = datetime(2016, 8, 1, 12, 20, 5)
+        for batch in range(2):  # more cells than fit into one query
+            self.writer.flush(dict((i, PokemonRow(
+                b64encode(str(i)), '47c{}'.format(i % 25), 16 + i % 3, 48.1 + i % 25 * 0.001, 11.5,
+                disappear_time + timedelta(minutes=i % 4))) for i in range(batch * 50, batch * 50 + 50)), {}, {})
+
+        aggregates = (PokemonStats, HeatmapCell, SpawnpointSecond)
+        added = [sorted(cls.select().dicts()) for cls in aggregates]
+        for cls in aggregates:
+            cls.rebuild()
+        self.assertEqual([sorted(cls.select().dicts()) for cls in aggregates], added)
+
+    def test_outdated_aggregates_are_rebuilt(self):
+        self.writer.flush(self.sighting(1), {}, {})
+        PokemonStats.update(count=5).execute()
+        SchemaVersion.update(version=1).execute()
+
+        create_tables()
+        self.assertEqual(PokemonStats.get(PokemonStats.pokemon_id == 16).count, 1)
+
+    def test_failed_flush_reports_its_cells(self):
+        def fail(*batch):
+            raise ValueError('disk full')
+
+        failed = Queue()
+        self.writer.flush = fail
+        self.writer.add_failure_listener(failed.put)
+        self.writer.start()
+        self.writer.put(self.sighting(1), {}, {}, {42L: 1000})
+
+        self.assertEqual(failed.get(timeout=5), [42L])
+
+    def test_spawnpoints_are_learned_from_the_aggregate(self):
+        disappear_time = datetime(2016, 8, 1, 12, 20, 5)
+        for encounter_id, minute in ((1, 20), (2, 20), (3, 40)):
+            self.writer.flush({encounter_id: PokemonRow(
+                b64encode(str(encounter_id)), '47c3', 16, 48.1, 11.5,
+                disappear_time.replace(minute=minute))}, {}, {})
+
+        spawnpoints = learn_spawnpoints()
+        self.assertEqual([(s.spawnpoint_id, s.spawn_second) for s in spawnpoints], [('47c3', 5 * 60 + 5)])
+
+        SpawnpointSecond.rebuild()
+        self.assertEqual(learn_spawnpoints(), spawnpoints)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+import unittest
+
+sys.argv = sys.argv[:1]  # pogom.models parses the command line on import
+
+from pogom.scan import ScanConfig
+from pogom.shard import get_share
+
+
+def location(lat, lng, radius=100):
+    return {'location': '{},{}'.format(lat, lng), 'latitude': lat, 'longitude': lng,
+            'altitude': 0, 'radius': radius}
+
+
+class ScanLocationsTest(unittest.TestCase):
+    def setUp(self):
+        # The configuration is kept in class attributes
+        self.saved = ScanConfig.SCAN_LOCATIONS, ScanConfig.RESTART_LISTENERS
+        ScanConfig.SCAN_LOCATIONS = {}
+        ScanConfig.RESTART_LISTENERS = []
+        self.scan_config = ScanConfig()
+
+    def tearDown(self):
+        ScanConfig.SCAN_LOCATIONS, ScanConfig.RESTART_LISTENERS = self.saved
+
+    def test_update_removes_locations(self):
+        locations = [location(48.1, 11.5 + i * 0.01) for i in range(4)]
+        self.scan_config.update_scan_locations(locations)
+        self.scan_config.update_scan_locations(locations[1:3])
+
+        self.assertEqual(sorted(self.scan_config.SCAN_LOCATIONS),
+                         sorted(l['location'] for l in locations[1:3]))
+        self.assertEqual(self.scan_config.COVER_KEY, ScanConfig.locations_hash(
+            list(reversed(self.scan_config.SCAN_LOCATIONS.values()))))
+
+
+class ShareTest(unittest.TestCase):
+    def test_steps_only_go_to_processes_with_accounts(self):
+        accounts = [{'username': 'u{}'.format(i)} for i in range(3)]
+        shares = [get_share(index, 5, accounts) for index in range(5)]
+
+        steps = sorted(step for share_accounts, (index, count) in shares if share_accounts
+                       for step in xrange(index, 20, count))
+        self.assertEqual(steps, range(20))
+        self.assertEqual(sorted(a['username'] for share_accounts, _ in shares for a in share_accounts),
+                         ['u0', 'u1', 'u2'])
+
+
+if __name__ == '__main__':
+    unittest.main()